@@ -0,0 +1,246 @@
+"""
+Benchmarks for the decode, encode, discovery and publish paths.
+
+Feeds synthetic traffic profiles, or a recorded CAN log, through
+logamatic4000 with the MQTT client replaced by an in-process stand-in,
+so no broker is needed.
+
+Profiles:
+    idle:  all monitor objects rebroadcast without any change
+    large: 9 Heizkreise, 8 wall-hung boilers and the other monitor objects, with changes
+    dump:  the full config dump after ConfSender.request_settings
+    log:   a recorded log, if given
+
+Run with: python3 benchmark.py [--log recorded_can_log] [--json results.json]
+The log has one "/heizung/burner/can/raw/recv/ 0;421;88 00 0c 19 05 13 00 00"
+line per frame, as written by mosquitto_sub -v.
+"""
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import logamatic4000
+import mqtt_can
+import mqtt_logamatic
+import eco_can_tools
+import replay
+from mqtt_can import CanMsg
+
+MON_CAN_ID = 0x421
+CONF_CAN_ID = 0x21
+
+
+class MqttStandIn:
+    "Keeps published messages in memory instead of sending them to a broker"
+    def __init__(self):
+        self.messages = 0
+        self.retained = {}
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages += 1
+        if retain:
+            self.retained[topic] = payload
+
+
+def monitor_frames(rounds, oids=None, change_every=10):
+    """
+    Build a bus profile like the Logamatic's periodic monitor broadcast:
+    every implemented monitor object is sent block by block, and only every
+    *change_every* round one byte changes. change_every=0 never changes.
+    """
+    frames = []
+    for r in range(rounds):
+        for oid, t in logamatic4000.monitor_types.items():
+            if not t.dataclass or (oids and oid not in oids):
+                continue
+            for offs in range(0, t.datalen, 6):
+                mem = [0x20, 0x21, 0x22, 0x23, 0x24, 0x25]
+                if change_every and r % change_every == 0:
+                    mem[r % 6] = r & 0xff
+                frames.append(CanMsg(MON_CAN_ID, bytes([oid, offs] + mem)))
+    return frames
+
+
+def config_frames(dumps=20):
+    """
+    All blocks of all config objects, like the settings dump after
+    request_settings, repeated *dumps* times with alternating values.
+    """
+    frames = []
+    for r in range(dumps):
+        for oid, t in logamatic4000.conf_types.items():
+            # Config blocks are aligned at 7 bytes
+            for offs in range(0, t.datalen - 6, 7):
+                frames.append(CanMsg(CONF_CAN_ID, bytes([oid, offs, 0x02, 0x11, 0x28 + r % 2, 0x2a, 0x02, 0x14])))
+    return frames
+
+
+def profiles(logfile=None):
+    hk = [0x80, 0x81, 0x82, 0x83, 0x8A, 0x8B, 0x8C, 0x8D, 0x8E]
+    haengend = list(range(0x92, 0x9A))
+    p = {
+        "idle": monitor_frames(100, change_every=0),
+        "large": monitor_frames(100, oids=hk + haengend + [0x84, 0x89, 0x9B, 0x9E]),
+        "dump": config_frames(),
+    }
+    if logfile:
+        p["log"] = [m for ts, msgs in replay.read_log(logfile) for m in msgs]
+    return p
+
+
+def text_log(frames):
+    "Format frames like a recorded log"
+    return ["{0} {1:x};{2:x};{3}\n".format(mqtt_can.topic_recv, m.rtr, m.pkid, m.data.hex(" ")) for m in frames]
+
+
+def reset():
+    logamatic4000.data_objects.clear()
+    logamatic4000.block_cache.clear()
+    logamatic4000.frames_suppressed = 0
+    logamatic4000.frames_processed = 0
+    # Do not try to talk to the bus
+    logamatic4000.conf_requested = True
+    mqtt_logamatic.discovery_sent.clear()
+    mqtt_logamatic.pending_publish.clear()
+    mqtt_logamatic.client = MqttStandIn()
+
+
+def best_of(fn, repeat=5, setup=reset):
+    "Returns the best time of fn() over repeat runs"
+    best = None
+    for _ in range(repeat):
+        setup()
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+def bench_handle_can_recv(frames):
+    "Frames through handle_can_recv, with batched publishing"
+    def run():
+        for i in range(0, len(frames), 32):
+            logamatic4000.handle_can_recv_batch(frames[i:i+32])
+            mqtt_logamatic.flush()
+    t = best_of(run)
+    return {"frames": len(frames), "frames_per_s": len(frames) / t,
+            "published": mqtt_logamatic.client.messages, "change_detection": logamatic4000.frame_stats()}
+
+
+def bench_obase_recv(n=20000):
+    "Obase.recv of a changing block, so every call decodes"
+    o = logamatic4000.MonHeizkreis(0x80, "Heizkreis 1")
+    data = [bytes([0x80, 0, 0x04, 0x02, 0x30 + i % 2, 0x22, 0x2a, 0x2b]) for i in range(n)]
+    def run():
+        for d in data:
+            o.recv(d, 1)
+    return {"calls_per_s": n / best_of(run)}
+
+
+def bench_conf_encode(n=20000):
+    o = logamatic4000.ConfHeizkreis(0x07, "Heizkreis 1")
+    def run():
+        for i in range(n):
+            o.encode("T_Tag", 21.5)
+    return {"calls_per_s": n / best_of(run)}
+
+
+def bench_publish_discovery(n=20000):
+    "publish_discovery for values, which have already been announced"
+    o = logamatic4000.MonHeizkreis(0x80, "Heizkreis 1")
+    dt = o.datatypes[3]
+    def run():
+        for i in range(n):
+            mqtt_logamatic.publish_discovery(o.prefix, dt.name, dt.metadata, o.monid, o.name, dt.fullname)
+    def setup():
+        reset()
+        mqtt_logamatic.publish_discovery(o.prefix, dt.name, dt.metadata, o.monid, o.name, dt.fullname)
+    return {"calls_per_s": n / best_of(run, setup=setup)}
+
+
+def bench_str_msg(frames):
+    lines = text_log(frames)
+    def run():
+        for l in lines:
+            eco_can_tools.str_msg(l)
+    return {"lines": len(lines), "lines_per_s": len(lines) / best_of(run)}
+
+
+def bench_pipeline(frames):
+    "eco_can_tools streaming pipeline over an in-memory dump"
+    data = "".join(text_log(frames)).encode()
+    def run():
+        for l in eco_can_tools.pipeline(io.BytesIO(data)):
+            pass
+    return {"lines": len(frames), "lines_per_s": len(frames) / best_of(run)}
+
+
+def bench_alloc(frames):
+    """
+    Trace the memory of parsing a log into CanMsg objects and the memory
+    retained by decoding it in the steady state.
+    """
+    lines = text_log(frames)
+    reset()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    frames = [m for l in lines for m in replay.parse_line(l)[1]]
+    parsed = tracemalloc.get_traced_memory()[0] - start
+    # Create the data objects first, to only trace the steady state
+    for m in frames[:len(frames)//10]:
+        logamatic4000.handle_can_recv(m)
+    base = tracemalloc.get_traced_memory()[0]
+    for m in frames[len(frames)//10:]:
+        logamatic4000.handle_can_recv(m)
+    retained = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return {"bytes_per_parsed_frame": parsed / len(frames), "bytes_retained": retained}
+
+
+def run_all(logfile=None):
+    results = {}
+    p = profiles(logfile)
+    for name, frames in p.items():
+        results["handle_can_recv/" + name] = bench_handle_can_recv(frames)
+    results["Obase.recv"] = bench_obase_recv()
+    results["ConfBase.encode"] = bench_conf_encode()
+    results["publish_discovery"] = bench_publish_discovery()
+    results["str_msg"] = bench_str_msg(monitor_frames(20))
+    results["pipeline"] = bench_pipeline(monitor_frames(20))
+    results["alloc"] = bench_alloc(monitor_frames(100))
+    if logfile:
+        results["alloc/log"] = bench_alloc(p["log"])
+    return results
+
+
+def format_result(r):
+    return ", ".join("{0}: {1:.0f}".format(k, v) if isinstance(v, float) else "{0}: {1}".format(k, v)
+                     for k, v in r.items())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the decoder")
+    parser.add_argument("--log", help="recorded CAN log to use as additional profile")
+    parser.add_argument("--json", help="write results as JSON to this file, - for stdout")
+    args = parser.parse_args()
+    results = run_all(args.log)
+    if args.json:
+        doc = {
+            "timestamp": time.time(),
+            "python": sys.version.split()[0],
+            "machine": platform.machine(),
+            "node": platform.node(),
+            "results": results,
+        }
+        if args.json == "-":
+            json.dump(doc, sys.stdout, indent=2)
+        else:
+            with open(args.json, "w") as f:
+                json.dump(doc, f, indent=2)
+    else:
+        for name, r in results.items():
+            print("{0:28s} {1}".format(name, format_result(r)))
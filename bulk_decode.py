@@ -0,0 +1,222 @@
+"""
+Bulk decoder for whole object images and recorded logs, for offline analysis.
+
+Decodes all typed positions of many object images at once and returns a
+struct of arrays: {value name: array with one value per image}.
+NumPy is optional. Without it, the same results are returned as lists,
+decoded value by value.
+
+Example:
+    frames = replay.read_log("can.log")
+    for oid, cols in decode_log(frames).items():
+        print(hex(oid), cols["t"][-1], cols)
+"""
+import logamatic4000
+from logamatic4000 import (
+    BLOCKLEN, DataUInt8, DataTempRaum, DataTempAussen, DataUIntMultiByte,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Frames decoded at once by decode_log
+CHUNK_FRAMES = 100000
+
+
+def get_datatypes(oid, message_types):
+    "Shared datatypes of the layout of oid, or None"
+    t = message_types.get(oid)
+    if not t or not t.dataclass:
+        return None
+    layout = t.layout or t.dataclass.layout
+    if not layout:
+        return None
+    return logamatic4000.compiled_layouts[layout].datatypes
+
+
+def fields(datatypes):
+    "Yields (datatype, positions) of each value, multi-byte values once"
+    for p, dt in enumerate(datatypes):
+        if not dt:
+            continue
+        if isinstance(dt, DataUIntMultiByte.ByteHook):
+            if dt.byteindex == 0:
+                parent = dt.parent
+                n = len(parent.bytehooks)
+                yield parent, parent.positions or tuple(range(p + 1 - n, p + 1))
+        else:
+            yield dt, (p,)
+
+
+def is_numeric(dt):
+    "True for datatypes decoded to numbers, False for enums and bit fields"
+    return isinstance(dt, (DataUIntMultiByte, DataTempRaum, DataTempAussen, DataUInt8))
+
+
+def decode_byte(dt, b):
+    "Scalar decode, None for invalid values"
+    try:
+        return dt.decode(b).get(dt.name)
+    except (IndexError, KeyError, ValueError):
+        return None
+
+
+def decode_images(datatypes, images):
+    """
+    Args:
+        datatypes: of the object layout
+        images: 2d array (images x datalen) of the object memory. With NumPy
+            an int16 array, where -1 marks unknown bytes; without, a list of lists with None.
+    Returns:
+        dict value name -> array (NumPy) or list of values, None or NaN for unknown
+    """
+    if np is None:
+        return decode_images_py(datatypes, images)
+    images = np.asarray(images, dtype=np.int16)
+    out = {}
+    for dt, pos in fields(datatypes):
+        cols = images[:, pos]
+        unknown = (cols < 0).any(axis=1)
+        b = cols[:, 0]
+        if isinstance(dt, DataUIntMultiByte):
+            v = np.zeros(len(images), dtype=np.float64)
+            for i in range(len(pos)):
+                v = v * 256 + cols[:, i]
+        elif isinstance(dt, DataTempRaum):
+            v = b / 2
+            unknown |= b == 110    # 55 °C means invalid
+        elif isinstance(dt, DataTempAussen):
+            v = b.astype(np.uint8).view(np.int8).astype(np.float64)
+        elif isinstance(dt, DataUInt8):
+            v = b.astype(np.float64)
+        else:
+            # Enums and bit fields: decode each distinct byte once
+            u, inv = np.unique(b, return_inverse=True)
+            labels = np.array([decode_byte(dt, int(x)) if x >= 0 else None for x in u], dtype=object)
+            out[dt.name] = labels[inv.reshape(-1)]
+            continue
+        v[unknown] = np.nan
+        out[dt.name] = v
+    return out
+
+
+def decode_images_py(datatypes, images):
+    out = {}
+    for dt, pos in fields(datatypes):
+        col = []
+        for img in images:
+            bs = [img[p] for p in pos]
+            if any(b is None or b < 0 for b in bs):
+                col.append(None)
+            elif isinstance(dt, DataUIntMultiByte):
+                col.append(int.from_bytes(bytes(bs), "big"))
+            else:
+                col.append(decode_byte(dt, bs[0]))
+        out[dt.name] = col
+    return out
+
+
+def images_from_blocks(datalen, offsets, blocks, initial=None):
+    """
+    Object images after each received block, unknown bytes are -1 (None without NumPy).
+    Args:
+        offsets: block offset per frame
+        blocks: 6 data bytes per frame
+        initial: image before the first frame, e.g. the last image of the previous chunk
+    """
+    n = len(offsets)
+    if np is None:
+        images = []
+        img = list(initial) if initial is not None else [None] * datalen
+        for o, blk in zip(offsets, blocks):
+            if o + BLOCKLEN <= datalen:
+                img = list(img)
+                img[o:o+BLOCKLEN] = blk
+            images.append(img)
+        return images
+    offsets = np.asarray(offsets, dtype=np.int64)
+    blocks = np.asarray(blocks, dtype=np.int16).reshape(n, BLOCKLEN)
+    valid = offsets + BLOCKLEN <= datalen
+    rows = np.repeat(np.arange(n)[valid], BLOCKLEN)
+    cols = (offsets[valid, None] + np.arange(BLOCKLEN)).ravel()
+    # Forward fill: each byte takes its value from the last frame, which set it
+    last = np.full((n, datalen), -1, dtype=np.int32 if n < 1 << 31 else np.int64)
+    last[rows, cols] = rows
+    last = np.maximum.accumulate(last, axis=0)
+    data = np.full((n, datalen), -1, dtype=np.int16)
+    data[rows, cols] = blocks[valid].ravel()
+    before = np.asarray(initial, dtype=np.int16) if initial is not None else -1
+    images = np.where(last >= 0, data[np.maximum(last, 0), np.arange(datalen)], before)
+    return images.astype(np.int16)
+
+
+def decode_image(oid, mem, message_types=logamatic4000.conf_types):
+    "Decode one complete object memory, e.g. all 62 bytes of a ConfHeizkreis"
+    datatypes = get_datatypes(oid, message_types)
+    cols = decode_images(datatypes, [list(mem)])
+    return {k: v[0] for k, v in cols.items()}
+
+
+def decode_log(frames, chunk=CHUNK_FRAMES):
+    """
+    Decode all frames of a log per object, *chunk* frames at a time, so the
+    intermediate object images stay bounded. The result still holds one row
+    per frame; for archives, which don't fit into memory, see can_export and log_analysis.
+    Args:
+        frames: iterable of (timestamp, [CanMsg]), like replay.read_log
+    Returns:
+        dict oid -> {"t": timestamps, value name: values}, one row per received frame of the object
+    """
+    collected = {}
+    last_images = {}
+    parts = {}
+    n = 0
+    for ts, msgs in frames:
+        for m in msgs:
+            if len(m.data) != 8:
+                continue
+            types = logamatic4000.monitor_types if m.pkid & 0x400 else logamatic4000.conf_types
+            oid = m.data[0]
+            if oid not in types:
+                continue
+            c = collected.get(oid)
+            if c is None:
+                c = collected[oid] = (types, [], [], [])
+            c[1].append(ts)
+            c[2].append(m.data[1])
+            c[3].append(bytes(m.data[2:8]))
+            n += 1
+        if n >= chunk:
+            decode_chunk(collected, last_images, parts)
+            collected = {}
+            n = 0
+    decode_chunk(collected, last_images, parts)
+    result = {}
+    for oid, p in parts.items():
+        if len(p) == 1:
+            result[oid] = p[0]
+        elif np is not None:
+            result[oid] = {k: np.concatenate([cols[k] for cols in p]) for k in p[0]}
+        else:
+            result[oid] = {k: [v for cols in p for v in cols[k]] for k in p[0]}
+    return result
+
+
+def decode_chunk(collected, last_images, parts):
+    "Decode the frames collected by decode_log, appends the columns to parts[oid]"
+    for oid, (types, ts, offsets, blocks) in collected.items():
+        datatypes = get_datatypes(oid, types)
+        if not datatypes:
+            continue
+        if np is not None:
+            blocks = np.frombuffer(b"".join(blocks), dtype=np.uint8)
+        images = images_from_blocks(len(datatypes), offsets, blocks, last_images.get(oid))
+        last_images[oid] = list(images[-1])
+        cols = decode_images(datatypes, images)
+        if np is not None:
+            ts = np.array([t if t is not None else np.nan for t in ts], dtype=np.float64)
+        cols["t"] = ts
+        parts.setdefault(oid, []).append(cols)
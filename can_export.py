@@ -0,0 +1,236 @@
+"""
+Export recorded CAN dumps to columnar files, for analysis with NumPy or pandas.
+
+The dump (see replay.py for the format) is parsed in chunks of lines, and each
+chunk is appended to one directory per day (UTC) of the frame timestamps:
+
+    outdir/2024-01-15/frames/t.d        timestamp, NaN if the dump has none
+    outdir/2024-01-15/frames/rtr.B      rtr, mon, dst, src, typ, offs: one byte per frame
+    outdir/2024-01-15/frames/data.B     the 6 data bytes per frame
+    outdir/2024-01-15/mon_88/t.d        one row per received frame of monitor object 0x88
+    outdir/2024-01-15/mon_88/T_m.d      numeric values, NaN if unknown
+    outdir/2024-01-15/mon_88/Kesselstatus.h   raw byte of enums, -1 if unknown
+    outdir/2024-01-15/meta.json         row counts, object names and enum labels
+
+The suffix of a column file is its array typecode. The files are plain arrays
+in native byte order without header, so they can be memory mapped as they are:
+    np.memmap("outdir/2024-01-15/mon_88/T_m.d", dtype="d", mode="r")
+Frames without timestamp go to outdir/unknown. Exporting another dump into
+the same directory appends to it.
+
+Run with: python3 can_export.py [--chunk LINES] dumpfile outdir
+"""
+import argparse
+import array
+import json
+import logging
+import math
+import mmap
+import os
+import time
+import logamatic4000
+import bulk_decode
+import replay
+from bulk_decode import np
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+CHUNK_LINES = 100000
+FRAME_COLUMNS = ("rtr", "mon", "dst", "src", "typ", "offs")
+
+
+def read_chunks(fn, lines=CHUNK_LINES):
+    "Yields lists of (timestamp, [CanMsg]) of up to *lines* lines of a dump"
+    chunk = []
+    for rec in replay.read_log(fn):
+        chunk.append(rec)
+        if len(chunk) >= lines:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def append_column(path, typecode, values):
+    with open(path, "ab") as f:
+        if np is not None and isinstance(values, np.ndarray):
+            values.astype(typecode).tofile(f)
+        else:
+            array.array(typecode, values).tofile(f)
+
+
+def read_column(path):
+    "Memory mapped column file as memoryview of its typecode"
+    typecode = path.rsplit(".", 1)[1]
+    with open(path, "rb") as f:
+        if not os.path.getsize(path):
+            return memoryview(array.array(typecode))
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+
+def load_partition(directory):
+    "All columns of a day: {'frames/t': column, 'mon_88/T_m': column, ...}, as np.memmap if NumPy is available"
+    columns = {}
+    for sub in sorted(os.listdir(directory)):
+        subdir = os.path.join(directory, sub)
+        if not os.path.isdir(subdir):
+            continue
+        for fn in sorted(os.listdir(subdir)):
+            name, typecode = fn.rsplit(".", 1)
+            path = os.path.join(subdir, fn)
+            if np is not None and os.path.getsize(path):
+                columns[sub + "/" + name] = np.memmap(path, dtype=typecode, mode="r")
+            else:
+                columns[sub + "/" + name] = read_column(path)
+    return columns
+
+
+class Partition:
+    "Output directory of one day"
+    def __init__(self, directory):
+        self.directory = directory
+        self.meta_path = os.path.join(directory, "meta.json")
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"rows": {}, "objects": {}, "labels": {}}
+
+    def append(self, table, columns):
+        """
+        Args:
+            table: "frames" or the object directory, e.g. "mon_88"
+            columns: {name: (typecode, values)}
+        """
+        d = os.path.join(self.directory, table)
+        os.makedirs(d, exist_ok=True)
+        n = 0
+        for name, (typecode, values) in columns.items():
+            append_column(os.path.join(d, "{0}.{1}".format(name, typecode)), typecode, values)
+            n = len(values)
+        self.meta["rows"][table] = self.meta["rows"].get(table, 0) + n
+
+    def write_meta(self):
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.meta_path)
+
+
+def partition_name(ts):
+    if ts is None or math.isnan(ts):
+        return "unknown"
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+class Exporter:
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.partitions = {}
+        # (prefix, oid) -> last object image, carried over chunks
+        self.images = {}
+        self.frames = 0
+        self.skipped = 0
+
+    def partition(self, name):
+        p = self.partitions.get(name)
+        if p is None:
+            p = self.partitions[name] = Partition(os.path.join(self.outdir, name))
+        return p
+
+    def add_chunk(self, chunk):
+        # day -> frame columns; days in the order of the dump
+        days = {}
+        day_of = {}
+        for ts, msgs in chunk:
+            key = int(ts // 86400) if ts is not None else None
+            name = day_of.get(key)
+            if name is None:
+                name = day_of[key] = partition_name(ts)
+            cols = days.get(name)
+            if cols is None:
+                cols = days[name] = {c: [] for c in ("t", "data") + FRAME_COLUMNS}
+            t = ts if ts is not None else math.nan
+            for m in msgs:
+                if len(m.data) != 8:
+                    self.skipped += 1
+                    continue
+                cols["t"].append(t)
+                cols["rtr"].append(m.rtr)
+                cols["mon"].append(m.pkid >> 10 & 1)
+                cols["dst"].append(m.pkid >> 5 & 0x1f)
+                cols["src"].append(m.pkid & 0x1f)
+                cols["typ"].append(m.data[0])
+                cols["offs"].append(m.data[1])
+                cols["data"].append(m.data[2:8])
+        for name, cols in days.items():
+            p = self.partition(name)
+            self.add_objects(p, cols)
+            data = cols.pop("data")
+            self.frames += len(data)
+            columns = {"t": ("d", cols.pop("t"))}
+            columns.update((c, ("B", v)) for c, v in cols.items())
+            p.append("frames", columns)
+            with open(os.path.join(p.directory, "frames", "data.B"), "ab") as f:
+                f.write(b"".join(data))
+            p.write_meta()
+
+    def add_objects(self, p, cols):
+        "Decode the frames of each known data object and append one row per frame"
+        rows = {}
+        for i, (mon, typ) in enumerate(zip(cols["mon"], cols["typ"])):
+            rows.setdefault((mon, typ), []).append(i)
+        for (mon, oid), idx in rows.items():
+            types = logamatic4000.monitor_types if mon else logamatic4000.conf_types
+            datatypes = bulk_decode.get_datatypes(oid, types)
+            if not datatypes:
+                continue
+            prefix = "mon" if mon else "cnf"
+            table = "{0}_{1:02x}".format(prefix, oid)
+            offsets = [cols["offs"][i] for i in idx]
+            blocks = [cols["data"][i] for i in idx]
+            if np is not None:
+                blocks = np.frombuffer(b"".join(blocks), dtype=np.uint8)
+            images = bulk_decode.images_from_blocks(len(datatypes), offsets, blocks, self.images.get((prefix, oid)))
+            self.images[(prefix, oid)] = list(images[-1])
+            decoded = bulk_decode.decode_images(datatypes, images)
+            columns = {"t": ("d", [cols["t"][i] for i in idx])}
+            labels = p.meta["labels"]
+            for dt, pos in bulk_decode.fields(datatypes):
+                if bulk_decode.is_numeric(dt):
+                    v = decoded[dt.name]
+                    if np is None:
+                        v = [x if x is not None else math.nan for x in v]
+                    columns[dt.name] = ("d", v)
+                else:
+                    codes = images[:, pos[0]] if np is not None else [
+                        img[pos[0]] if img[pos[0]] is not None else -1 for img in images]
+                    columns[dt.name] = ("h", codes)
+                    known = labels.setdefault(table + "/" + dt.name, {})
+                    for c in (np.unique(codes).tolist() if np is not None else set(codes)):
+                        if c >= 0 and str(c) not in known:
+                            known[str(c)] = bulk_decode.decode_byte(dt, c)
+            p.meta["objects"][table] = {"oid": oid, "name": types[oid].name,
+                                        "values": {k: tc for k, (tc, v) in columns.items()}}
+            p.append(table, columns)
+
+
+def export(fn, outdir, lines=CHUNK_LINES):
+    e = Exporter(outdir)
+    for chunk in read_chunks(fn, lines):
+        e.add_chunk(chunk)
+    return e
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(description="Export a recorded CAN dump to columnar files per day")
+    parser.add_argument("dumpfile")
+    parser.add_argument("outdir")
+    parser.add_argument("--chunk", type=int, default=CHUNK_LINES, help="lines parsed per chunk")
+    args = parser.parse_args()
+    t0 = time.monotonic()
+    e = export(args.dumpfile, args.outdir, args.chunk)
+    log.info("Exported %d frames into %d partitions in %.1f s, skipped %d frames, %d unparsable lines",
+             e.frames, len(e.partitions), time.monotonic() - t0, e.skipped, replay.stats["errors"])
@@ -0,0 +1,240 @@
+"""
+Indexed capture of the raw CAN traffic.
+
+Received frames are appended to a binary file of fixed size records:
+timestamp (float64) and the frame as mqtt_can.FRAME, 20 bytes per frame.
+A sidecar index (capture file + ".idx") has one entry per block of
+BLOCK_RECORDS records: the time range of the block and a bitmap of the
+object ids in it, for monitor and other frames separately. Queries by time
+range or object id only read the blocks, which can contain matches, and the
+not yet indexed tail.
+
+Record:
+    python3 capture.py record can.cap
+Query, printed in the dump format of replay.py:
+    python3 capture.py query can.cap --from "2024-01-16 00:00" --to "2024-01-17 00:00" --oid 0c --mon 0
+"""
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import paho.mqtt.client
+import mqtt_can
+from mqtt_can import CanMsg
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+RECORD = struct.Struct("<d" + mqtt_can.FRAME.format.lstrip("<"))
+# time min, time max, oid bitmap: 256 bits monitor, 256 bits other frames
+INDEX = struct.Struct("<dd64s")
+BLOCK_RECORDS = 4096
+
+
+class BlockSummary:
+    "Time range and object ids of a block of records"
+    def __init__(self):
+        self.tmin = float("inf")
+        self.tmax = float("-inf")
+        self.oids = bytearray(64)
+
+    def add(self, ts, pkid, data):
+        if ts < self.tmin:
+            self.tmin = ts
+        if ts > self.tmax:
+            self.tmax = ts
+        if data:
+            bit = data[0] + (0 if pkid & 0x400 else 256)
+            self.oids[bit >> 3] |= 1 << (bit & 7)
+
+    def add_records(self, buf):
+        for ts, flags, pkid, dlc, data in RECORD.iter_unpack(buf):
+            self.add(ts, pkid, data[:dlc])
+
+    def pack(self):
+        return INDEX.pack(self.tmin, self.tmax, bytes(self.oids))
+
+
+def oid_mask(oids, mon=None):
+    "Bitmap of the index, which matches any of oids; mon: 1 monitor, 0 other frames, None both"
+    mask = bytearray(64)
+    for oid in oids:
+        for m in ((0, 1) if mon is None else (mon,)):
+            bit = oid + (0 if m else 256)
+            mask[bit >> 3] |= 1 << (bit & 7)
+    return int.from_bytes(mask, "little")
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.f = open(path, "ab")
+        if size % RECORD.size:
+            # Drop a record, which was not written completely
+            size -= size % RECORD.size
+            self.f.truncate(size)
+        self.count = size // RECORD.size
+        self.index = open(self.index_path, "ab")
+        self.repair_index()
+        self.block = BlockSummary()
+        tail = self.count % BLOCK_RECORDS
+        if tail:
+            with open(path, "rb") as f:
+                f.seek((self.count - tail) * RECORD.size)
+                self.block.add_records(f.read(tail * RECORD.size))
+
+    def repair_index(self):
+        "Truncate or complete the index to the full blocks in the capture file"
+        blocks = self.count // BLOCK_RECORDS
+        indexed = os.path.getsize(self.index_path) // INDEX.size
+        if indexed > blocks or os.path.getsize(self.index_path) % INDEX.size:
+            indexed = min(indexed, blocks)
+            self.index.truncate(indexed * INDEX.size)
+        if indexed < blocks:
+            log.info("Rebuild index of %d blocks", blocks - indexed)
+            with open(self.path, "rb") as f:
+                f.seek(indexed * BLOCK_RECORDS * RECORD.size)
+                for _ in range(indexed, blocks):
+                    b = BlockSummary()
+                    b.add_records(f.read(BLOCK_RECORDS * RECORD.size))
+                    self.index.write(b.pack())
+            self.index.flush()
+
+    def add(self, ts, msgs):
+        "Append the CanMsg list msgs received at ts"
+        for m in msgs:
+            self.f.write(RECORD.pack(ts, mqtt_can.FLAG_RTR if m.rtr else 0, m.pkid & 0x7ff, len(m.data), bytes(m.data)))
+            self.block.add(ts, m.pkid, m.data)
+            self.count += 1
+            if self.count % BLOCK_RECORDS == 0:
+                # The index must not get ahead of the data
+                self.f.flush()
+                self.index.write(self.block.pack())
+                self.index.flush()
+                self.block = BlockSummary()
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+        self.index.close()
+
+
+class CaptureReader:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.path.getsize(path)
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.count = len(self.buf) // RECORD.size
+        index_path = path + ".idx"
+        idx = b""
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                idx = f.read()
+        n = min(len(idx) // INDEX.size, self.count // BLOCK_RECORDS)
+        self.index = [(tmin, tmax, int.from_bytes(oids, "little"))
+                      for tmin, tmax, oids in INDEX.iter_unpack(idx[:n * INDEX.size])]
+
+    def __len__(self):
+        return self.count
+
+    def blocks(self, t0=None, t1=None, mask=None):
+        "Record ranges (start, end), which can contain matches"
+        for i, (tmin, tmax, oids) in enumerate(self.index):
+            if t0 is not None and tmax < t0 or t1 is not None and tmin >= t1 or mask is not None and not oids & mask:
+                continue
+            yield i * BLOCK_RECORDS, (i + 1) * BLOCK_RECORDS
+        if len(self.index) * BLOCK_RECORDS < self.count:
+            yield len(self.index) * BLOCK_RECORDS, self.count
+
+    def query(self, t0=None, t1=None, oids=None, mon=None):
+        """
+        Yields (timestamp, CanMsg) of the frames with t0 <= timestamp < t1.
+        Args:
+            oids: collection of object ids (first data byte), None for all
+            mon: 1 monitor frames, 0 other frames, None both
+        """
+        mask = oid_mask(oids, mon) if oids is not None else None
+        oids = frozenset(oids) if oids is not None else None
+        for start, end in self.blocks(t0, t1, mask):
+            for ts, flags, pkid, dlc, data in RECORD.iter_unpack(self.buf[start * RECORD.size:end * RECORD.size]):
+                if t0 is not None and ts < t0 or t1 is not None and ts >= t1:
+                    continue
+                if mon is not None and bool(pkid & 0x400) != bool(mon):
+                    continue
+                data = data[:dlc]
+                if oids is not None and (not data or data[0] not in oids):
+                    continue
+                yield ts, CanMsg(pkid, data, flags & mqtt_can.FLAG_RTR)
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+
+
+def record(path):
+    "Record the frames received over MQTT into path, like eco_can_tools.sniff_can"
+    writer = CaptureWriter(path)
+    binary = mqtt_can.can_format == "binary"
+    client = paho.mqtt.client.Client()
+
+    def on_connect(client, userdata, flags, rc, properties=None):
+        log.info("Connected %d, recording into %s, %d frames", rc, path, writer.count)
+        client.subscribe(mqtt_can.topic_bin_recv if binary else mqtt_can.topic_recv)
+
+    def on_message(client, userdata, msg):
+        try:
+            msgs = mqtt_can.unpack_frames(msg.payload) if binary else mqtt_can.parse_text_frames(msg.payload)
+            writer.add(time.time(), msgs)
+        except Exception:
+            log.exception("Exception on_message %s : %s", msg.topic, msg.payload)
+
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(os.getenv('MQTT_READ_HOST', 'localhost'))
+    try:
+        while True:
+            client.loop(timeout=1.0)
+            writer.flush()
+    except KeyboardInterrupt:
+        client.disconnect()
+    finally:
+        writer.close()
+
+
+def parse_time(s):
+    "Unix timestamp, or local time 'YYYY-MM-DD[ HH:MM[:SS]]'"
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(s, fmt))
+        except ValueError:
+            pass
+    return float(s)
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(description="Record or query an indexed CAN capture")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("record", help="record the frames received over MQTT").add_argument("file")
+    q = sub.add_parser("query", help="print the matching frames in the dump format")
+    q.add_argument("file")
+    q.add_argument("--from", dest="t0", type=parse_time, help="local time 'YYYY-MM-DD HH:MM' or unix timestamp")
+    q.add_argument("--to", dest="t1", type=parse_time)
+    q.add_argument("--oid", type=lambda v: [int(x, 16) for x in v.split(",")], help="object ids, hex, comma separated")
+    q.add_argument("--mon", type=int, choices=[0, 1], help="only monitor (1) or other (0) frames")
+    args = parser.parse_args()
+    if args.command == "record":
+        record(args.file)
+    else:
+        reader = CaptureReader(args.file)
+        out = sys.stdout
+        for ts, m in reader.query(args.t0, args.t1, args.oid, args.mon):
+            out.write("{0:.3f} {1} {2:x};{3:x};{4}\n".format(ts, mqtt_can.topic_recv, m.rtr, m.pkid, m.data.hex(" ")))
@@ -54,26 +54,113 @@ def format_msg(rtr, mon, d, s, typ, offs, mem):
 
     return shortf.format(rtr, mon, d, s, typ, offs, " ".join(("{0:02x}".format(b) for b in mem))
     )
-def dec_file(fn, fo=None):
+# Streaming pipeline: read_lines -> parse_lines -> filter(predicate, ...) -> format_msgs -> write_lines
+# Messages are (rtr, mon, d, s, typ, offs, mem) tuples like dec_can_msg returns.
+
+def read_lines(f, bufsize=1 << 20):
+    "Yields the lines of a binary file object, read in chunks of up to *bufsize*"
+    # read1 returns what is available, so lines from a pipe are not held back
+    read = getattr(f, "read1", f.read)
+    rest = b""
+    while True:
+        chunk = read(bufsize)
+        if not chunk:
+            break
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+def parse_lines(lines, on_error=None):
+    """
+    Yields message tuples of 'rtr;id;data' lines, with or without topic and timestamp in front.
+    Unparsable lines are skipped, or passed with the exception to on_error(line, exception).
+    """
+    for l in lines:
+        p = l.find(b";")
+        if p < 0:
+            if on_error and l.strip():
+                on_error(l, ValueError("No CAN frame"))
+            continue
+        try:
+            rtr, i, data = l[l.rfind(b" ", 0, p) + 1:].split(b";", 2)
+            i = int(i, 16)
+            data = bytes.fromhex(data.decode())
+            yield int(rtr), int(i & 0x400 > 0), (i >> 5) & 0b11111, i & 0b11111, data[0], data[1], data[2:]
+        except (ValueError, IndexError) as E:
+            if on_error:
+                on_error(l, E)
+
+def compile_filter(mon=None, d=None, s=None, typ=None, exclude_typ=()):
+    """
+    Predicate on message tuples, for filter(). Each argument is a value or a
+    collection of accepted values, None accepts all.
+    Example: compile_filter(mon=0, exclude_typ=[0, 1])
+    """
+    def accepted(v):
+        if v is None:
+            return None
+        return frozenset(v) if isinstance(v, (list, tuple, set, frozenset, range)) else frozenset([v])
+    conds = [(i, vs) for i, vs in ((1, accepted(mon)), (2, accepted(d)), (3, accepted(s)), (4, accepted(typ)))
+             if vs is not None]
+    exclude = frozenset(exclude_typ)
+    if not conds:
+        return lambda m: m[4] not in exclude
+    if len(conds) == 1 and not exclude:
+        (i, vs), = conds
+        return lambda m: m[i] in vs
+    return lambda m: m[4] not in exclude and all(m[i] in vs for i, vs in conds)
+
+def kwargs_filter(filt):
+    "Adapt a filter taking keyword arguments, like filt_no_mon, to a predicate on message tuples"
+    return lambda m: filt(rtr=m[0], mon=m[1], d=m[2], s=m[3], typ=m[4], offs=m[5], mem=m[6])
+
+def format_msgs(msgs):
+    "Yields format_msg output of each message"
+    shortf = "r:{0:x} m:{1:x} r:{2:02x} s:{3:02x} t:{4:02x} o:{5:02x} d:{6:s}".format
+    for rtr, mon, d, s, typ, offs, mem in msgs:
+        yield shortf(rtr, mon, d, s, typ, offs, mem.hex(" "))
+
+def write_lines(lines, fo, batch=4096):
+    "Write lines to the text file object fo, *batch* lines per write"
+    buf = []
+    for l in lines:
+        buf.append(l)
+        if len(buf) >= batch:
+            buf.append("")
+            fo.write("\n".join(buf))
+            buf = []
+    if buf:
+        buf.append("")
+        fo.write("\n".join(buf))
+
+def pipeline(f, predicate=None, on_error=None):
+    "Formatted lines of the messages in binary file object f, which pass predicate"
+    msgs = parse_lines(read_lines(f), on_error)
+    if predicate:
+        msgs = filter(predicate, msgs)
+    return format_msgs(msgs)
+
+def dec_file(fn, fo=None, predicate=None):
     if not fo: 
         fo =  fn+".dec"
-    with open(fn) as fr: 
+    with open(fn, "rb") as fr: 
         with open(fo, "w") as fw: 
-            fw.writelines((str_msg(l)+"\n" for l in fr)) 
+            write_lines(pipeline(fr, predicate), fw)
 
 # print(splitdumpline("/heizung/burner/can/raw/recv/ 0;38;c3 06 01 ff 19 5a 01 8e"))
 
-def stdio_can_dec(filt=None):
+def stdio_can_dec(filt=None, predicate=None):
+    "Decode stdin to stdout. filt is a keyword argument filter like filt_no_mon, predicate one of compile_filter"
+    import os
+    import stat
     import sys
-    while True:
-        l = sys.stdin.readline()
-        if not l: break
-        if l.strip():
-            try:
-                f = str_msg(l, filt)
-            except Exception as E:
-                f = str(E)
-            if f: sys.stdout.write(f + "\n")
+    if filt:
+        predicate = kwargs_filter(filt)
+    def on_error(l, E):
+        sys.stdout.write(str(E) + "\n")
+    write_lines(pipeline(sys.stdin.buffer, predicate, on_error), sys.stdout, batch=4096 if stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode) else 1)
 
 def sniff_can(filt=None):
     client = paho.mqtt.client.Client()
@@ -107,6 +194,11 @@ def filt_something_new(**k):
     t = k["typ"]
     return k["mon"] == False and t != 0 and t != 1 and t != 0xca and t != 0xcb and t != 0xc3 and t != 0xc0
 
+# Predicates on message tuples, for the pipeline
+pred_no_mon = compile_filter(mon=0)
+pred_bcast = compile_filter(d=0)
+pred_something_new = compile_filter(mon=0, exclude_typ=[0, 1, 0xca, 0xcb, 0xc3, 0xc0])
+
 
 def enc_can_msg(d, s, typ, offs, mem, mon=0, rtr=0):
     i = enc_can_id(d, s, mon)
@@ -147,6 +239,23 @@ def disconnect():
 
 client = paho.mqtt.client.Client()
 if __name__ == "__main__":
-    pass
-    # mqtt_can_dec(filt_no_mon)
-    # stdio_can_dec()
\ No newline at end of file
+    import argparse
+    import sys
+    def ints(v):
+        return [int(x, 16) for x in v.split(",")]
+    parser = argparse.ArgumentParser(description="Decode raw CAN dump lines from files or stdin")
+    parser.add_argument("files", nargs="*", help="dump files, stdin if none")
+    parser.add_argument("--mon", type=int, choices=[0, 1], help="only monitor (1) or other (0) messages")
+    parser.add_argument("--dst", type=ints, help="destinations, hex, comma separated")
+    parser.add_argument("--src", type=ints, help="sources, hex, comma separated")
+    parser.add_argument("--typ", type=ints, help="types, hex, comma separated")
+    parser.add_argument("--exclude-typ", type=ints, default=[], help="types to drop, hex, comma separated")
+    args = parser.parse_args()
+    predicate = None
+    if any(v is not None for v in (args.mon, args.dst, args.src, args.typ)) or args.exclude_typ:
+        predicate = compile_filter(args.mon, args.dst, args.src, args.typ, args.exclude_typ)
+    if not args.files:
+        stdio_can_dec(predicate=predicate)
+    for fn in args.files:
+        with open(fn, "rb") as f:
+            write_lines(pipeline(f, predicate), sys.stdout)
\ No newline at end of file
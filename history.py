@@ -0,0 +1,265 @@
+"""
+Embedded history of decoded values.
+
+Numeric value updates are appended to a ring buffer per value, together with
+min/max/mean rollups in 1 min, 15 min and 1 h buckets. The rollups are built
+from the received updates, which are only sent on changes, so the mean is
+not time weighted.
+
+With HISTORY_DIR set, the ring buffers are memory mapped files, one per value
+and resolution, and survive restarts. With HISTORY=1 they are kept in memory.
+
+Query from the command line:
+    python3 history.py "mon/Heizkreis 1/T_Vm" --since 7d --resolution 3600
+"""
+import argparse
+import bisect
+import logging
+import mmap
+import os
+import time
+import urllib.parse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+history_dir = os.getenv("HISTORY_DIR", "")
+enabled = bool(history_dir) or os.getenv("HISTORY", "0") == "1"
+raw_size = int(os.getenv("HISTORY_SIZE", "4096"))
+
+# bucket seconds -> number of buckets kept
+RESOLUTIONS = {
+    60: 7 * 24 * 60,      # a week
+    900: 31 * 24 * 4,     # a month
+    3600: 366 * 24,       # a year
+}
+
+
+class Ring:
+    """
+    Columnar ring buffer of float64 rows, in memory or in a memory mapped file.
+    Layout: capacity, count of appended rows, then each column with capacity values.
+    Column 0 is the timestamp.
+    An existing file is never resized, a file of another capacity raises ValueError.
+    With readonly, the file is mapped read only and its capacity is taken from its header.
+    """
+    HEADER = 2
+
+    def __init__(self, columns, capacity, path=None, readonly=False):
+        self.columns = columns
+        self.view = None
+        if path and (readonly or os.path.exists(path)):
+            self.open_existing(path, capacity, readonly)
+            return
+        self.capacity = capacity
+        size = (self.HEADER + columns * capacity) * 8
+        if path:
+            with open(path, "w+b") as f:
+                f.truncate(size)
+                self.buf = mmap.mmap(f.fileno(), size)
+        else:
+            self.buf = bytearray(size)
+        self.view = memoryview(self.buf).cast("d")
+        self.view[0] = capacity
+        self.view[1] = 0
+
+    def open_existing(self, path, capacity, readonly):
+        size = os.path.getsize(path)
+        if size < self.HEADER * 8 or size % 8:
+            raise ValueError("{0} is no history file".format(path))
+        with open(path, "rb" if readonly else "r+b") as f:
+            self.buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        self.view = memoryview(self.buf).cast("d")
+        if readonly:
+            capacity = int(self.view[0])
+        self.capacity = capacity
+        if self.view[0] != capacity or size != (self.HEADER + self.columns * capacity) * 8:
+            stored = self.view[0]
+            self.close()
+            raise ValueError("{0} has a capacity of {1:g} rows, not {2}".format(path, stored, capacity))
+
+    @property
+    def count(self):
+        return int(self.view[1])
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, *row):
+        c = self.count
+        i = c % self.capacity
+        for col, v in enumerate(row):
+            self.view[self.HEADER + col * self.capacity + i] = v
+        self.view[1] = c + 1
+
+    def physical(self, i):
+        "Index in the columns of the i-th oldest row"
+        c = self.count
+        start = c % self.capacity if c > self.capacity else 0
+        return (start + i) % self.capacity
+
+    def row(self, i):
+        p = self.HEADER + self.physical(i)
+        return tuple(self.view[p + col * self.capacity] for col in range(self.columns))
+
+    def __getitem__(self, i):
+        "Timestamp of the i-th oldest row, for bisect"
+        return self.view[self.HEADER + self.physical(i)]
+
+    def range(self, t0=None, t1=None):
+        "Rows with t0 <= timestamp < t1"
+        lo = bisect.bisect_left(self, t0) if t0 is not None else 0
+        hi = bisect.bisect_left(self, t1) if t1 is not None else len(self)
+        return [self.row(i) for i in range(lo, hi)]
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+
+
+class Rollup:
+    "Aggregates updates into buckets of (start, min, max, mean)"
+    def __init__(self, resolution, ring):
+        self.resolution = resolution
+        self.ring = ring
+        self.bucket = None
+        self.n = 0
+
+    def add(self, t, v):
+        b = t - t % self.resolution
+        if b != self.bucket:
+            if len(self.ring) and b <= self.ring[len(self.ring) - 1]:
+                # The bucket was already closed, e.g. before a restart
+                return
+            self.close_bucket()
+            self.bucket = b
+            self.min = self.max = self.sum = v
+            self.n = 1
+        else:
+            self.min = min(self.min, v)
+            self.max = max(self.max, v)
+            self.sum += v
+            self.n += 1
+
+    def close_bucket(self):
+        if self.n:
+            self.ring.append(self.bucket, self.min, self.max, self.sum / self.n)
+            self.n = 0
+
+    def current(self):
+        "The open bucket, or None"
+        if not self.n:
+            return None
+        return (self.bucket, self.min, self.max, self.sum / self.n)
+
+
+def series_path(directory, name, resolution):
+    if not directory:
+        return None
+    return os.path.join(directory, "{0}.{1}.hist".format(urllib.parse.quote(name, safe=""), resolution))
+
+
+class Series:
+    "History of one value: raw (timestamp, value) rows and the rollups"
+    def __init__(self, name, directory=None, readonly=False):
+        self.name = name
+        self.raw = Ring(2, raw_size, series_path(directory, name, 0), readonly)
+        self.rollups = {r: Rollup(r, Ring(4, n, series_path(directory, name, r), readonly))
+                        for r, n in RESOLUTIONS.items()}
+        self.restore_buckets()
+
+    def restore_buckets(self):
+        "Rebuild the open rollup buckets, which are only kept in memory, from the raw rows"
+        if not len(self.raw):
+            return
+        newest = self.raw[len(self.raw) - 1]
+        for r in self.rollups.values():
+            for t, v in self.raw.range(newest - newest % r.resolution):
+                r.add(t, v)
+
+    def append(self, t, v):
+        self.raw.append(t, v)
+        for r in self.rollups.values():
+            r.add(t, v)
+
+    def query(self, t0=None, t1=None, resolution=None):
+        """
+        Args:
+            t0, t1: time range, unix timestamps, t1 exclusive
+            resolution: None for raw (timestamp, value) rows, or one of RESOLUTIONS
+                for (bucket start, min, max, mean) rows
+        """
+        if not resolution:
+            return self.raw.range(t0, t1)
+        r = self.rollups[resolution]
+        rows = r.ring.range(t0, t1)
+        c = r.current()
+        if c and (t0 is None or c[0] >= t0) and (t1 is None or c[0] < t1):
+            rows.append(c)
+        return rows
+
+
+# "mon/Heizkreis 1/T_Vm" -> Series, None if its files can't be used
+series = {}
+
+
+def get_series(name):
+    if name in series:
+        return series[name]
+    if history_dir:
+        os.makedirs(history_dir, exist_ok=True)
+    try:
+        s = Series(name, history_dir)
+    except ValueError as E:
+        log.error("No history for %s: %s", name, E)
+        s = None
+    series[name] = s
+    return s
+
+
+def record(prefix, key, value, ts):
+    "Called for each value update. Non numeric values are ignored."
+    if not enabled or isinstance(value, bool) or not isinstance(value, (int, float)):
+        return
+    s = get_series("/".join(prefix + [key]))
+    if s is not None:
+        s.append(ts, value)
+
+
+def query(name, t0=None, t1=None, resolution=None):
+    "See Series.query. name is e.g. 'mon/Heizkreis 1/T_Vm'"
+    s = get_series(name)
+    return s.query(t0, t1, resolution) if s is not None else []
+
+
+def parse_duration(s):
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if s[-1] in units:
+        return float(s[:-1]) * units[s[-1]]
+    return float(s)
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(description="Query the value history in HISTORY_DIR")
+    parser.add_argument("name", help="value, e.g. 'mon/Heizkreis 1/T_Vm'")
+    parser.add_argument("--since", default="1d", help="duration, e.g. 30m, 12h, 7d")
+    parser.add_argument("--resolution", type=int, choices=[0] + list(RESOLUTIONS), default=0,
+                        help="bucket seconds, 0 for the raw updates")
+    args = parser.parse_args()
+    if not history_dir:
+        parser.error("HISTORY_DIR is not set")
+    if not os.path.exists(series_path(history_dir, args.name, 0)):
+        parser.error("No history for " + args.name)
+    # Read only, the files may be mapped by the running logamatic4000.py
+    try:
+        s = Series(args.name, history_dir, readonly=True)
+    except (ValueError, OSError) as E:
+        parser.error(str(E))
+    for row in s.query(time.time() - parse_duration(args.since), None, args.resolution):
+        print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[0])), *row[1:])
@@ -0,0 +1,87 @@
+"""
+Memory layouts of the Logamatic data objects.
+
+Each layout maps positions in the object memory to a datatype:
+    (position, datatype class name, value name, full name, metadata)
+position is a tuple for multi-byte values, most significant byte first.
+
+The layouts are compiled once by logamatic4000 into shared datatypes and
+decode plans. To decode a new object, add a layout here and reference it in
+monitor_types or conf_types with LogamaticType(..., layout="name").
+"""
+
+TEMP = {"device_class": "temperature", "unit_of_measurement": "°C"}
+ENUM = {"device_class": "enum"}
+# DataHKMode.codes
+HK_MODES = ["AUS", "EIN", "AUT"]
+
+
+def number(vmin, vmax, step, **kwargs):
+    "Metadata of a config value, shown as slider"
+    m = {"platform": "number", "min": vmin, "max": vmax, "step": step, "mode": "slider"}
+    m.update(kwargs)
+    return m
+
+
+MODE = {"platform": "select", "device_class": "enum", "options": HK_MODES}
+CONF_TEMP = {"unit_of_measurement": "°C", "device_class": "temperature"}
+
+# name -> (datalen, fields)
+monitor = {
+    "Heizkreis": (18, [
+        (0, "DataHKStat1", "Status1", "Betriebswerte 1", ENUM),
+        (1, "DataHKStat2", "Status2", "Betriebswerte 2", ENUM),
+        (2, "DataTempVorl", "T_Vs", "Vorlaufsolltemperatur", TEMP),
+        (3, "DataTempVorl", "T_Vm", "Vorlaufisttemperatur", TEMP),
+        (4, "DataTempRaum", "T_Rs", "Raumsolltemperatur", TEMP),
+        (5, "DataTempRaum", "T_Rm", "Raumisttemperatur", TEMP),
+    ]),
+    "Kessel": (42, [
+        (0, "DataTempVorl", "T_s", "Kesselvorlauf-Solltemperatur", TEMP),
+        (1, "DataTempVorl", "T_m", "Kesselvorlauf-Isttemperatur", TEMP),
+        (7, "DataUint8Hex", "Kesselstatus", "Kessel Betrieb Bits", ENUM),
+        (8, "DataUInt8", "Brenner_s", "Brenner Ansteuerung", ENUM),
+        (34, "DataUint8Hex", "Brennerstatus", "Brenner Status Bits", ENUM),
+    ]),
+    "KesselHaengend": (60, [
+        (6, "DataTempVorl", "T_s", "Kesselvorlauf-Solltemperatur", TEMP),
+        (7, "DataTempVorl", "T_m", "Kesselvorlauf-Isttemperatur", TEMP),
+        (14, "DataUint8Hex", "UBA", "HD-Mode der UBA", ENUM),
+        (20, "DataTempRueckl", "T_rm", "Kesselrücklauf-Isttemperatur", TEMP),
+    ]),
+    "Generic": (24, [
+        (0, "DataTempAussen", "T_Aus", "Außentemperatur", TEMP),
+        (18, "DataTempVorl", "T_Vs", "Anlagenvorlaufsolltemperatur", TEMP),
+        (19, "DataTempVorl", "T_Vm", "Anlagenvorlaufisttemperatur", TEMP),
+        (23, "DataTempVorl", "T_Vrm", "Regelgerätevorlaufisttemperatur", TEMP),
+    ]),
+    "Solar": (54, [
+        (10, "DataTempVorl", "T_Bufm", "Temperatur Speichermitte", TEMP),
+        (11, "DataTempVorl", "T_Rlm", "Anlagenrücklauftemperatur", TEMP),
+    ]),
+    "Waermemenge": (36, [
+        ((30, 31, 32, 33), "DataUIntMultiByte", "W_overall", "Wärmemenge gesamt",
+         {"device_class": "duration", "unit_of_measurement": "min"}),
+        ((6, 7), "DataUIntMultiByte", "W_today", "Wärmemenge heute", {}),
+        ((8, 9), "DataUIntMultiByte", "W_yesterday", "Wärmemenge Vortag", {}),
+    ]),
+    "WarmWasser": (12, [
+        (0, "DataWWStat1", "Status 1", "Betriebswerte 1", ENUM),
+        (1, "DataWWStat2", "Status 2", "Betriebswerte 2", ENUM),
+        (2, "DataTempWW", "T_s", "Warmwasser Solltemperatur", TEMP),
+        (3, "DataTempWW", "T_m", "Warmwasser Isttemperatur", TEMP),
+    ]),
+}
+
+conf = {
+    "Heizkreis": (62, [
+        (1, "DataTempAussen", "T_Sommer", "Sommer-Winter Schwelle", number(8, 18, 1, **CONF_TEMP)),
+        (2, "DataTempRaum", "T_Nacht", "Solltemperatur Nacht", number(10, 29, 0.5, **CONF_TEMP)),
+        (3, "DataTempRaum", "T_Tag", "Solltemperatur Tag", number(11, 30, 0.5, **CONF_TEMP)),
+        (4, "DataHKMode", "Modus", "Betriebsart", MODE),
+    ]),
+    "Warmwasser": (41, [
+        (10, "DataTempWW", "T_s", "Solltemperatur", number(10, 80, 1, **CONF_TEMP)),
+        (14, "DataHKMode", "Modus", "Betriebsart", MODE),
+    ]),
+}
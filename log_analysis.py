@@ -0,0 +1,194 @@
+"""
+Parallel analysis of large raw CAN dump archives.
+
+The dump files are split into shards of about SHARD_SIZE bytes at line
+boundaries, and the shards are decoded on all cores by a ProcessPoolExecutor,
+with eco_can_tools.parse_lines and the layouts of monitor_types/conf_types.
+The per-shard results are merged into one summary per data object:
+received frames, count/min/max/mean of each numeric value and the
+histogram of each enum value.
+
+Each shard starts with an unknown object memory, so values are only counted
+after the first frame of a shard has set their bytes.
+
+With --columnar, each shard is also exported by can_export to its own
+directory below the given one.
+
+Run with: python3 log_analysis.py [--jobs N] [--shard-size MB] [--columnar outdir] dumpfile ...
+"""
+import argparse
+import io
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import logamatic4000
+import bulk_decode
+import can_export
+import eco_can_tools
+import replay
+from bulk_decode import np
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+SHARD_SIZE = 64 << 20
+
+
+def shards(files, shard_size=SHARD_SIZE):
+    "Yields (filename, start, end) byte ranges of about shard_size"
+    for fn in files:
+        size = os.path.getsize(fn)
+        for start in range(0, size, shard_size):
+            yield fn, start, min(start + shard_size, size)
+
+
+def read_shard(fn, start, end):
+    "The lines starting in [start, end) of fn, as bytes"
+    with open(fn, "rb") as f:
+        if start:
+            # Skip the line, which started in the previous shard
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        if pos >= end:
+            return b""
+        data = f.read(end - pos)
+        if data.endswith(b"\n"):
+            return data
+        # Complete the last line, which continues in the next shard
+        return data + f.readline()
+
+
+def summarize(datatypes, offsets, blocks):
+    "Summary of the frames of one object, see analyse_shard"
+    if np is not None:
+        blocks = np.frombuffer(b"".join(blocks), dtype=np.uint8)
+    images = bulk_decode.images_from_blocks(len(datatypes), offsets, blocks)
+    decoded = bulk_decode.decode_images(datatypes, images)
+    values = {}
+    for dt, pos in bulk_decode.fields(datatypes):
+        if bulk_decode.is_numeric(dt):
+            v = decoded[dt.name]
+            if np is not None:
+                v = v[~np.isnan(v)]
+                values[dt.name] = [len(v), float(v.min()), float(v.max()), float(v.sum())] if len(v) else [0, None, None, 0.0]
+            else:
+                v = [x for x in v if x is not None]
+                values[dt.name] = [len(v), min(v), max(v), float(sum(v))] if v else [0, None, None, 0.0]
+        else:
+            if np is not None:
+                codes, counts = np.unique(images[:, pos[0]], return_counts=True)
+                pairs = zip(codes.tolist(), counts.tolist())
+            else:
+                hist = {}
+                for img in images:
+                    c = img[pos[0]] if img[pos[0]] is not None else -1
+                    hist[c] = hist.get(c, 0) + 1
+                pairs = hist.items()
+            values[dt.name] = {str(bulk_decode.decode_byte(dt, c)): n for c, n in pairs if c >= 0}
+    return {"frames": len(offsets), "values": values}
+
+
+def analyse_shard(shard, columnar=None):
+    """
+    Decode one shard.
+    Returns:
+        {"lines": n, "errors": n, "frames": n, "objects": {"mon_88": object summary}}, where the
+        object summary is {"frames": n, "values": {name: [count, min, max, sum] or {label: count}}}
+    """
+    fn, start, end = shard
+    data = read_shard(fn, start, end)
+    result = {"lines": 0, "errors": 0, "frames": 0, "objects": {}}
+    def on_error(l, E):
+        result["errors"] += 1
+    collected = {}
+    for rtr, mon, d, s, typ, offs, mem in eco_can_tools.parse_lines(eco_can_tools.read_lines(io.BytesIO(data)), on_error):
+        result["frames"] += 1
+        if len(mem) != 6:
+            continue
+        c = collected.get((mon, typ))
+        if c is None:
+            c = collected[(mon, typ)] = ([], [])
+        c[0].append(offs)
+        c[1].append(mem)
+    result["lines"] = result["frames"] + result["errors"]
+    for (mon, oid), (offsets, blocks) in collected.items():
+        datatypes = bulk_decode.get_datatypes(oid, logamatic4000.monitor_types if mon else logamatic4000.conf_types)
+        if datatypes:
+            result["objects"]["{0}_{1:02x}".format("mon" if mon else "cnf", oid)] = summarize(datatypes, offsets, blocks)
+    if columnar:
+        name = "{0}.{1:012d}".format(os.path.basename(fn), start)
+        e = can_export.Exporter(os.path.join(columnar, name))
+        lines = data.decode(errors="replace").splitlines()
+        for i in range(0, len(lines), can_export.CHUNK_LINES):
+            chunk = []
+            for l in lines[i:i + can_export.CHUNK_LINES]:
+                try:
+                    if l.strip():
+                        chunk.append(replay.parse_line(l))
+                except ValueError:
+                    pass
+            e.add_chunk(chunk)
+    return result
+
+
+def merge(results):
+    "Merge analyse_shard results"
+    total = {"lines": 0, "errors": 0, "frames": 0, "objects": {}}
+    for r in results:
+        for k in ("lines", "errors", "frames"):
+            total[k] += r[k]
+        for name, o in r["objects"].items():
+            t = total["objects"].setdefault(name, {"frames": 0, "values": {}})
+            t["frames"] += o["frames"]
+            for vname, v in o["values"].items():
+                tv = t["values"].get(vname)
+                if tv is None:
+                    t["values"][vname] = v
+                elif isinstance(v, dict):
+                    for label, n in v.items():
+                        tv[label] = tv.get(label, 0) + n
+                elif v[0]:
+                    if tv[0]:
+                        tv[1] = min(tv[1], v[1])
+                        tv[2] = max(tv[2], v[2])
+                    else:
+                        tv[1], tv[2] = v[1], v[2]
+                    tv[0] += v[0]
+                    tv[3] += v[3]
+    return total
+
+
+def analyse(files, jobs=None, shard_size=SHARD_SIZE, columnar=None):
+    "Analyse all files on *jobs* processes, all cores by default"
+    work = list(shards(files, shard_size))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return merge(pool.map(analyse_shard, work, [columnar] * len(work)))
+
+
+def report(total):
+    print("{0:d} lines, {1:d} frames, {2:d} unparsable".format(total["lines"], total["frames"], total["errors"]))
+    for name, o in sorted(total["objects"].items()):
+        print("{0} ({1:d} frames)".format(name, o["frames"]))
+        for vname, v in o["values"].items():
+            if isinstance(v, dict):
+                print("    {0:14s} {1}".format(vname, ", ".join("{0}: {1:d}".format(k, n) for k, n in
+                                                                 sorted(v.items(), key=lambda i: -i[1]))))
+            elif v[0]:
+                print("    {0:14s} min {1:g} max {2:g} mean {3:.2f} ({4:d} values)".format(
+                    vname, v[1], v[2], v[3] / v[0], v[0]))
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(description="Analyse raw CAN dumps on all cores")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--jobs", type=int, help="worker processes, default: all cores")
+    parser.add_argument("--shard-size", type=float, default=SHARD_SIZE / (1 << 20), help="MB per shard")
+    parser.add_argument("--columnar", help="also export each shard to columnar files below this directory")
+    args = parser.parse_args()
+    t0 = time.monotonic()
+    total = analyse(args.files, args.jobs, int(args.shard_size * (1 << 20)), args.columnar)
+    report(total)
+    log.info("%d lines in %.1f s", total["lines"], time.monotonic() - t0)
@@ -1,10 +1,19 @@
 import mqtt_can
 import mqtt_logamatic
+import history
+import layouts
+import metrics
 import logging
-from collections import namedtuple
+from collections import deque, namedtuple
 import queue
 import time
 import sys
+import heapq
+import itertools
+import json
+import marshal
+import os
+from types import MappingProxyType
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
@@ -14,11 +23,14 @@ log_send.setLevel(logging.INFO)
 timestamp = time.time
 
 class DataTypeBase():
+    # True, if the value is decoded with decode_at from the object memory
+    positional = False
+
     def __init__(self, name, fullname="", metadata={}):
         self.name = name
         self.fullname = fullname if fullname else name
-        self.values = {}
-        self.metadata = dict(metadata)
+        # Datatypes are shared between data objects of the same layout
+        self.metadata = MappingProxyType(dict(metadata))
 
     def decode(self, byte):
         """
@@ -61,7 +73,14 @@ class DataTempAussen(DataTypeBase):
         return int(value)
 
 class DataUIntMultiByte(DataTypeBase):
+    """
+    Unsigned int over several positions.
+    They use big endian but number them like little, so byte zero will come last.
+    The complete value is decoded from the object memory, when byte zero is received.
+    """
     class ByteHook(DataTypeBase):
+        positional = True
+
         def __init__(self, parent, byteindex):
             self.parent = parent
             self.byteindex = byteindex
@@ -78,19 +97,24 @@ class DataUIntMultiByte(DataTypeBase):
         def fullname(self):
             return self.parent.fullname
 
-        def decode(self, byte):
-            self.parent.bytesvalues[self.byteindex] = byte
-            # Update the complete value after all bytes have been received.
-            # They use big endian but number them like little, so byte zero will come last.
-            if self.byteindex == 0:
-                v = int.from_bytes(self.parent.bytesvalues, byteorder='little', signed=False)
-                return {self.parent.name: v}
-            else:
+        def decode_at(self, mem, p):
+            if self.byteindex != 0:
                 return {}
+            positions = self.parent.positions
+            if positions:
+                v = int.from_bytes(bytes(mem[q] for q in positions), byteorder='big', signed=False)
+            else:
+                v = int.from_bytes(mem[p+1-len(self.parent.bytehooks):p+1], byteorder='big', signed=False)
+            return {self.parent.name: v}
 
-    def __init__(self, bytecount, name, fullname='', metadata={}):
+    def __init__(self, bytecount, name, fullname='', metadata={}, positions=None):
+        """
+        Args:
+            positions: memory positions, most significant byte first.
+                If None, the bytes must be consecutive.
+        """
         super().__init__(name, fullname, metadata)
-        self.bytesvalues = [0] * bytecount
+        self.positions = tuple(positions) if positions else None
         self.bytehooks = [self.ByteHook(self, i) for i in range(bytecount)]
 
     def byte(self, i):
@@ -196,37 +220,102 @@ class DataWWStat2(DataTypeBase):
         v = "{1} 0x{0:02X}".format(int(byte), "|".join(flags))
         return {self.name: v}
 
+BLOCKLEN = 6
+
+def build_decode_plan(datatypes, datalen):
+    """
+    Precompute the typed positions for every possible block offset.
+    Returns:
+        dict of block offset -> tuple of (position, datatype)
+    """
+    return {
+        i: tuple((p, datatypes[p]) for p in range(i, i+BLOCKLEN) if datatypes[p])
+        for i in range(datalen - BLOCKLEN + 1)
+    }
+
+def build_names(datatypes):
+    """
+    Returns:
+        dict of value name -> (position, datatype), the first position of each name
+    """
+    names = {}
+    for p, dt in enumerate(datatypes):
+        if dt and dt.name not in names:
+            names[dt.name] = (p, dt)
+    return names
+
 class Obase:
-    def __init__(self, monid, name, datalen):
+    blocklen = BLOCKLEN
+    # Name of the layout in compiled_layouts, e.g. "mon/Heizkreis"
+    layout = None
+
+    def __init__(self, monid, name, datalen=None, layout=None):
+        """
+        The datatypes come from the shared, compiled layout, if given
+        as argument or class attribute. Otherwise subclasses fill
+        self.datatypes in their constructor.
+        """
         self.monid = monid
         self.name = name
         self.prefix = ["base", name]
+        layout = layout or self.layout
+        if layout:
+            l = compiled_layouts[layout]
+            datalen = l.datalen
+            self.datatypes = l.datatypes
+            self.decode_plan = l.decode_plan
+            self.names = l.names
+        else:
+            self.datatypes = [None]*datalen
+            self.decode_plan = None
+            self.names = None
         self.datalen = datalen
-        self.mem = [None]*datalen
-        self.datatypes = [None]*datalen
+        self.mem = bytearray(datalen)
+        self.mem_received = set()   # block offsets, which have been received at least once
         self.values = {}
         self.value_timestamps = {}
 
-    def recv(self, databytes):
-        blocklen = 6
-        now = timestamp()
-        i = databytes[0]
+    def build_decode_plan(self):
+        """
+        Build the decode plan of self.datatypes on the first recv, and only once.
+        Objects with a layout share the plan of the compiled layout.
+        """
+        self.decode_plan = build_decode_plan(self.datatypes, self.datalen)
+        return self.decode_plan
+
+    def recv(self, databytes, start=0):
+        """
+        Args:
+            databytes: buffer with the block offset at start, followed by the block
+            start: index of the block offset in databytes
+        """
+        blocklen = self.blocklen
+        i = databytes[start]
         if i+blocklen > self.datalen:
-            log.warning("Monitor 0x%x data out of bounds %d, data %s", self.monid, self.datalen, str(databytes))
+            log.warning("Monitor 0x%x data out of bounds %d, data %s", self.monid, self.datalen, bytes(databytes).hex(" "))
             return
-        self.mem[i:i+blocklen] = databytes[1:]
-        for p in range(i, i+blocklen):
-            if not self.datatypes[p]:
-                log.debug("Mon recv %d: no datatype", p)
-                continue
-            log.debug("Mon recv %d: %s", p, self.datatypes[p].name)
-            newval = self.datatypes[p].decode(self.mem[p])
-            for nk in newval:
-                log.debug("Mon recv got %s", "/".join(self.prefix + [nk]))
-                if nk not in self.values or self.values[nk] != newval[nk]:
-                    self.values[nk] = newval[nk]
+        block = databytes[start+1:start+1+blocklen]
+        if i in self.mem_received and self.mem[i:i+blocklen] == block:
+            # Most blocks are rebroadcast unchanged, nothing to decode
+            return
+        if metrics.enabled:
+            t0 = time.perf_counter()
+        self.mem[i:i+blocklen] = block
+        self.mem_received.add(i)
+        plan = self.decode_plan if self.decode_plan is not None else self.build_decode_plan()
+        now = timestamp()
+        mem = self.mem
+        values = self.values
+        for p, dt in plan[i]:
+            log.debug("Mon recv %d: %s", p, dt.name)
+            newval = dt.decode_at(mem, p) if dt.positional else dt.decode(mem[p])
+            for nk, nv in newval.items():
+                if nk not in values or values[nk] != nv:
+                    values[nk] = nv
                     self.value_timestamps[nk] = now
                     self.update_event(nk, p)
+        if metrics.enabled:
+            metric_decode_seconds.observe(time.perf_counter() - t0, (self.prefix[0],))
 
     def get_value(self, k):
         return self.values[k]
@@ -238,6 +327,10 @@ class Obase:
             return "--"
 
     def update_event(self, k, p):
+        self.publish(k, p)
+        history.record(self.prefix, k, self.values[k], self.value_timestamps[k])
+
+    def publish(self, k, p):
         mqtt_logamatic.publish_update(
             self.prefix,
             k,
@@ -248,198 +341,125 @@ class Obase:
             self.datatypes[p].fullname
         )
 
+    def get_state(self):
+        "State for the snapshot"
+        return (bytes(self.mem), sorted(self.mem_received), self.values, self.value_timestamps)
+
+    def set_state(self, state):
+        "Restore a state from get_state"
+        mem, received, values, value_timestamps = state
+        if len(mem) != self.datalen:
+            raise ValueError("Snapshot of 0x{:x} has length {}".format(self.monid, len(mem)))
+        self.mem[:] = mem
+        self.mem_received = set(received)
+        self.values = dict(values)
+        self.value_timestamps = dict(value_timestamps)
+
+    def publish_all(self):
+        """
+        Publish all known values, e.g. after restoring a snapshot.
+        """
+        plan = self.decode_plan if self.decode_plan is not None else self.build_decode_plan()
+        for i in sorted(self.mem_received):
+            for p, dt in plan[i]:
+                newval = dt.decode_at(self.mem, p) if dt.positional else dt.decode(self.mem[p])
+                for nk in newval:
+                    if nk in self.values:
+                        self.publish(nk, p)
+
 
 class MonBase(Obase):
-    def __init__(self, monid, name, datalen):
-        super().__init__(monid, name, datalen)
+    def __init__(self, monid, name, datalen=None, layout=None):
+        super().__init__(monid, name, datalen, layout)
         self.prefix = ["mon", name]
 
 
 class MonHeizkreis(MonBase):
-    def __init__(self, monid, name):
-        super().__init__(monid, name, 18)
-        self.datatypes[0] = DataHKStat1(
-            "Status1", "Betriebswerte 1", {"device_class": "enum"}
-        )
-        self.datatypes[1] = DataHKStat2(
-            "Status2", "Betriebswerte 2", {"device_class": "enum"}
-        )
-        self.datatypes[2] = DataTempVorl(
-            "T_Vs",
-            "Vorlaufsolltemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[3] = DataTempVorl(
-            "T_Vm",
-            "Vorlaufisttemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[4] = DataTempRaum(
-            "T_Rs",
-            "Raumsolltemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[5] = DataTempRaum(
-            "T_Rm",
-            "Raumisttemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
+    layout = "mon/Heizkreis"
 
 
 class MonKessel(MonBase):
-    def __init__(self, monid, name):
-        super().__init__(monid, name, 42)
-        self.datatypes[0] = DataTempVorl(
-            "T_s",
-            "Kesselvorlauf-Solltemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[1] = DataTempVorl(
-            "T_m",
-            "Kesselvorlauf-Isttemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[7] = DataUint8Hex(
-            "Kesselstatus", "Kessel Betrieb Bits", {"device_class": "enum"}
-        )
-        self.datatypes[8] = DataUInt8(
-            "Brenner_s", "Brenner Ansteuerung", {"device_class": "enum"}
-        )
-        self.datatypes[34] = DataUint8Hex(
-            "Brennerstatus", "Brenner Status Bits", {"device_class": "enum"}
-        )
+    layout = "mon/Kessel"
 
 
 class MonKesselHaengend(MonBase):
-    def __init__(self, monid, name):
-        super().__init__(monid, name, 60)
-        self.datatypes[6] = DataTempVorl(
-            "T_s",
-            "Kesselvorlauf-Solltemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[7] = DataTempVorl(
-            "T_m",
-            "Kesselvorlauf-Isttemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[14] = DataUint8Hex(
-            "UBA", "HD-Mode der UBA", {"device_class": "enum"}
-        )
-        self.datatypes[20] = DataTempRueckl(
-            "T_rm",
-            "Kesselrücklauf-Isttemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
+    layout = "mon/KesselHaengend"
 
 
 class MonGeneric(MonBase):
-    def __init__(self, monid, name):
-        super().__init__(monid, name, 24)
-        self.datatypes[0] = DataTempAussen(
-            "T_Aus",
-            "Außentemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[18] = DataTempVorl(
-            "T_Vs",
-            "Anlagenvorlaufsolltemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[19] = DataTempVorl(
-            "T_Vm",
-            "Anlagenvorlaufisttemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[23] = DataTempVorl(
-            "T_Vrm",
-            "Regelgerätevorlaufisttemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
+    layout = "mon/Generic"
 
 
 class MonSolar(MonBase):
-    def __init__(self, monid, name):
-        super().__init__(monid, name, 54)
-        self.datatypes[10] = DataTempVorl(
-            "T_Bufm",
-            "Temperatur Speichermitte",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[11] = DataTempVorl(
-            "T_Rlm",
-            "Anlagenrücklauftemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
+    layout = "mon/Solar"
 
 
 class MonWaermemenge(MonBase):
-    def __init__(self, monid, name):
-        super().__init__(monid, name, 36)
-
-        overall = DataUIntMultiByte(
-            4,
-            "W_overall",
-            "Wärmemenge gesamt",
-            {"device_class": "duration", "unit_of_measurement": "min"},
-        )
-        self.datatypes[30] = overall.byte(3)
-        self.datatypes[31] = overall.byte(2)
-        self.datatypes[32] = overall.byte(1)
-        self.datatypes[33] = overall.byte(0)
-
-        today = DataUIntMultiByte(2, "W_today", "Wärmemenge heute")
-        self.datatypes[6] = today.byte(1)
-        self.datatypes[7] = today.byte(0)
-
-        yesterday = DataUIntMultiByte(2, "W_yesterday", "Wärmemenge Vortag")
-        self.datatypes[8] = yesterday.byte(1)
-        self.datatypes[9] = yesterday.byte(0)
+    layout = "mon/Waermemenge"
 
 
 class MonWarmWasser(MonBase):
-    def __init__(self, monid, name):
-        super().__init__(monid, name, 12)
-        self.datatypes[0] = DataWWStat1(
-            "Status 1", "Betriebswerte 1", {"device_class": "enum"}
-        )
-        self.datatypes[1] = DataWWStat2(
-            "Status 2", "Betriebswerte 2", {"device_class": "enum"}
-        )
-        self.datatypes[2] = DataTempWW(
-            "T_s",
-            "Warmwasser Solltemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
-        self.datatypes[3] = DataTempWW(
-            "T_m",
-            "Warmwasser Isttemperatur",
-            {"device_class": "temperature", "unit_of_measurement": "°C"},
-        )
+    layout = "mon/WarmWasser"
 
 
 class ConfBase(Obase):
-    def __init__(self, monid, name, datalen):
-        super().__init__(monid, name, datalen)
+    def __init__(self, monid, name, datalen=None, layout=None):
+        super().__init__(monid, name, datalen, layout)
         self.prefix = ["cnf", self.name]
-    def encode(self, name, value):
-        dn = None
-        for d in self.datatypes:
-            if d and d.name == name:
-                dn = d
-                break
-        if not dn:
+    def find(self, name):
+        "Returns position and datatype of the value name"
+        if self.names is None:
+            self.names = build_names(self.datatypes)
+        try:
+            return self.names[name]
+        except KeyError:
             raise ValueError("Data object {} contains no {}".format(self.name, name))
-        i = self.datatypes.index(dn)
 
+    def encode_byte(self, name, value):
+        """
+        Returns:
+            block offset, index in the block, encoded byte
+        """
+        i, dn = self.find(name)
         # Config block offsets are aligned at 7 bytes, however the 7th byte is never received
+        o, mi = divmod(i, 7)
+        b = dn.encode(value)
+        if not 0 <= b <= 255:
+            raise ValueError("{0} of {1} out of range: {2}".format(name, self.name, value))
+        return o * 7, mi, b
+
+    def encode(self, name, value):
         # 0x65 means "empty", which means, keep the current value.
+        o, mi, b = self.encode_byte(name, value)
         mem = [0x65]*6
-        o, mi = divmod(i, 7)
-        o *= 7
-        mem[mi] = dn.encode(value)
+        mem[mi] = b
         return o, mem
 
+    def publish(self, k, p):
+        if (self.monid, k) in conf_sender.optimistic:
+            # Keep showing the requested value until the write is confirmed or failed
+            return
+        super().publish(k, p)
+
+    def decode_byte(self, name, byte):
+        "The value, which the encoded byte of encode_byte sets"
+        i, dn = self.find(name)
+        return dn.decode(byte)[name]
+
+    def publish_optimistic(self, name, value, requested):
+        "Publish value as if its write was already confirmed"
+        i, dn = self.find(name)
+        mqtt_logamatic.publish_update(self.prefix, name, value, dn.metadata,
+                                      self.monid, self.name, dn.fullname)
+        mqtt_logamatic.publish_attributes(self.prefix, name, {"pending": True, "requested": requested})
+
+    def reconcile(self, name, status):
+        "Replace the optimistic value by the decoded one, rolls back failed writes"
+        i, dn = self.find(name)
+        if name in self.values:
+            self.publish(name, i)
+        mqtt_logamatic.publish_attributes(self.prefix, name, {"pending": False, "status": status})
+
 class DataHKMode(DataTypeBase):
     codes = ["AUS", "EIN", "AUT"]
     def decode(self, byte):
@@ -457,83 +477,52 @@ class DataHKMode(DataTypeBase):
 
 
 class ConfHeizkreis(ConfBase):
-    def __init__(self, monid, name):
-        super().__init__(monid, name, 62)
-        self.datatypes[1] = DataTempAussen(
-            "T_Sommer",
-            "Sommer-Winter Schwelle",
-            {
-                "platform": "number",
-                "min": 8,
-                "max": 18,
-                "step": 1,
-                "mode": "slider",
-                "unit_of_measurement": "°C",
-                "device_class": "temperature",
-            },
-        )
-        self.datatypes[2] = DataTempRaum(
-            "T_Nacht",
-            "Solltemperatur Nacht",
-            {
-                "platform": "number",
-                "min": 10,
-                "max": 29,
-                "step": 0.5,
-                "mode": "slider",
-                "unit_of_measurement": "°C",
-                "device_class": "temperature",
-            },
-        )
-        self.datatypes[3] = DataTempRaum(
-            "T_Tag",
-            "Solltemperatur Tag",
-            {
-                "platform": "number",
-                "min": 11,
-                "max": 30,
-                "step": 0.5,
-                "mode": "slider",
-                "unit_of_measurement": "°C",
-                "device_class": "temperature",
-            },
-        )
-        self.datatypes[4] = DataHKMode(
-            "Modus",
-            "Betriebsart",
-            {"platform": "select", "device_class": "enum", "options": DataHKMode.codes},
-        )
+    layout = "cnf/Heizkreis"
 
 
 class ConfWarmwasser(ConfBase):
-    def __init__(self, monid, name):
-        super().__init__(monid, name, 41)
-        self.datatypes[10] = DataTempWW(
-            "T_s",
-            "Solltemperatur",
-            {
-                "platform": "number",
-                "min": 10,
-                "max": 80,
-                "step": 1,
-                "mode": "slider",
-                "unit_of_measurement": "°C",
-                "device_class": "temperature",
-            },
-        )
-        self.datatypes[14] = DataHKMode(
-            "Modus",
-            "Betriebsart",
-            {"platform": "select", "device_class": "enum", "options": DataHKMode.codes},
-        )
+    layout = "cnf/Warmwasser"
+
+
+datatype_classes = {c.__name__: c for c in (
+    DataUInt8, DataUint8Hex, DataTempVorl, DataTempRueckl, DataTempWW, DataTempRaum, DataTempAussen,
+    DataUIntMultiByte, DataHKStat1, DataHKStat2, DataWWStat1, DataWWStat2, DataHKMode,
+)}
+
+class Layout():
+    "A memory layout from layouts.py, compiled into datatypes and decode plan shared by all its objects"
+    def __init__(self, datalen, fields):
+        datatypes = [None]*datalen
+        for pos, typename, name, fullname, metadata in fields:
+            cls = datatype_classes[typename]
+            if isinstance(pos, tuple):
+                dt = cls(len(pos), name, fullname, metadata, positions=pos)
+                for i, p in enumerate(pos):
+                    datatypes[p] = dt.byte(len(pos) - 1 - i)
+            else:
+                datatypes[pos] = cls(name, fullname, metadata)
+        self.datalen = datalen
+        self.datatypes = tuple(datatypes)
+        self.decode_plan = build_decode_plan(self.datatypes, datalen)
+        self.names = build_names(self.datatypes)
+
+compiled_layouts = {}
+for kind, table in (("mon", layouts.monitor), ("cnf", layouts.conf)):
+    for lname, (datalen, fields) in table.items():
+        compiled_layouts[kind + "/" + lname] = Layout(datalen, fields)
 
 
 class LogamaticType():
-    def __init__(self, name, datalen, dataclass=None, shortname=""):
+    def __init__(self, name, datalen, dataclass=None, shortname="", layout=None):
+        """
+        Args:
+            layout: name in compiled_layouts, to decode with a generic dataclass (MonBase or ConfBase)
+        """
         self.name = name
         self.datalen = datalen
         self.dataclass = dataclass
         self.shortname = shortname
+        self.layout = layout
 
 monitor_types = {
 # Monitor data
@@ -602,6 +591,25 @@ conf_types = {
 # reverse map: name -> id
 conf_names = { conf_types[k].name: k for k in conf_types }
 
+def build_cmd_routes():
+    """
+    Command topics of all config values with a layout.
+    Returns:
+        dict of topic -> (oid, value name), value name None for the topic of the whole object
+    """
+    routes = {}
+    for oid, t in conf_types.items():
+        layout = t.layout or (t.dataclass.layout if t.dataclass else None)
+        if not layout:
+            continue
+        name = t.shortname if t.shortname else t.name
+        routes[mqtt_logamatic.get_set_cnf_topic(["cnf"], name)] = (oid, None)
+        for vname in compiled_layouts[layout].names:
+            routes[mqtt_logamatic.get_set_cnf_topic(["cnf", name], vname)] = (oid, vname)
+    return routes
+
+cmd_routes = build_cmd_routes()
+
 data_objects = {}
 
 def get_data_object(oid, message_types):
@@ -609,7 +617,10 @@ def get_data_object(oid, message_types):
         if oid in message_types:
             if message_types[oid].dataclass:
                 name = message_types[oid].shortname if message_types[oid].shortname else message_types[oid].name
-                data_objects[oid] = message_types[oid].dataclass(oid,name)
+                if message_types[oid].layout:
+                    data_objects[oid] = message_types[oid].dataclass(oid, name, layout=message_types[oid].layout)
+                else:
+                    data_objects[oid] = message_types[oid].dataclass(oid, name)
                 log.debug("New can data object 0x%x", oid)
             else:
                 log.debug("No dataclass implemented for oid 0x%x", oid)
@@ -628,9 +639,13 @@ mon_received = 0
 conf_received = 0
 conf_requested = False
 
-def can_recv_callback(msg):
-    recv_queue.put(RecvMessage(handle_can_recv, msg))
-    log.debug("Incoming CAN id %d data %s", msg.pkid, str(msg.data))
+def can_recv_callback(msgs):
+    recv_queue.put(RecvMessage(handle_can_recv_batch, msgs))
+    log.debug("Incoming CAN batch of %d", len(msgs))
+
+def handle_can_recv_batch(msgs):
+    for msg in msgs:
+        handle_can_recv(msg)
 
 def handle_can_recv(msg):
     global mon_received, conf_received, conf_requested
@@ -641,29 +656,62 @@ def handle_can_recv(msg):
         conf_sender.request_settings()
         conf_requested = True
 
+    if metrics.enabled and len(msg.data):
+        metric_frames.inc((msg.pkid >> 10 & 1, "{0:02x}".format(msg.data[0])))
     try:
         if msg.pkid & 0x400:   # monitor data
             mon_received += recv_can_message(msg, monitor_types)
         else:                   # could be conf data
+            confirmed = conf_sender.check_echo(msg) if conf_sender.verifying else None
             conf_received += recv_can_message(msg, conf_types)
+            if confirmed:
+                # Only now the values of the echo are decoded
+                for oid, vname in confirmed:
+                    conf_sender.settle(oid, vname, "confirmed")
         recv_can_handshake(msg)
     except Exception as E:
         log.exception(E)
         raise
 
+# Last received frame data per (oid, offset), to drop unchanged rebroadcasts early.
+# The data of a CanMsg is immutable, so it is referenced, not copied.
+block_cache = {}
+frames_suppressed = 0
+frames_processed = 0
+
 def recv_can_message(msg, message_types):
-    if len(msg.data) != 8:
+    global frames_suppressed, frames_processed
+    data = msg.data
+    if len(data) != 8:
         log.warning("CAN message with len != 8")
-        return
-    oid = msg.data[0]
+        return False
+    oid = data[0]
+    key = (oid, data[1])
+    if block_cache.get(key) == data:
+        frames_suppressed += 1
+        return True
     log.debug("Can id=%d oid=0x%x", msg.pkid, oid)
     o = get_data_object(oid, message_types)
     if o:
-        o.recv(msg.data[1:])
+        o.recv(data, 1)
+        block_cache[key] = data
+        frames_processed += 1
         log.debug("Update for mon oid 0x%x done", oid)
         return True
     return False
 
+def frame_stats():
+    "Counters of the raw change detection"
+    return {"suppressed": frames_suppressed, "processed": frames_processed}
+
+metric_frames = metrics.counter("logamatic_can_frames_total", "Received CAN frames per object", ("mon", "oid"))
+metric_decode_seconds = metrics.histogram("logamatic_decode_seconds", "Decode time of a changed block", ("kind",))
+metric_handler_seconds = metrics.histogram("logamatic_handler_seconds", "Time in the handlers of the main loop", ("handler",))
+metrics.gauge("logamatic_frames_suppressed_total", "Frames dropped by the change detection",
+              lambda: frames_suppressed, "counter")
+metrics.gauge("logamatic_frames_processed_total", "Frames decoded", lambda: frames_processed, "counter")
+metrics.gauge("logamatic_recv_queue_depth", "Messages waiting in the receive queue", lambda: recv_queue.qsize())
+
 def enc_can_id(d, s, mon=0):
      m5 = 0b11111
      i = mon << 10
@@ -682,31 +730,148 @@ def mqtt_command_callback(msg):
     recv_queue.put(RecvMessage(handle_cmd, msg))
 
 def handle_cmd(msg):
+    """
+    set_cnf/<object>/<value> sets one value,
+    set_cnf/<object> with a JSON object {"<value>": value, ...} several at once.
+    """
     try:
         value = msg.payload.decode()
         log.debug("Receive MQTT command %s : %s", msg.topic, value)
-        t = msg.topic.split("/")
-        oname = t[-2]
-        vname = t[-1]
-        conf_sender.send_conf(oname, vname, value)
+        # paho sets the monotonic receive time
+        received = getattr(msg, "timestamp", None)
+        route = cmd_routes.get(msg.topic)
+        if route is None:
+            log.warning("Unknown config command topic %s", msg.topic)
+            return
+        oid, vname = route
+        conf_sender.send_conf_oid(oid, json.loads(value) if vname is None else {vname: value}, received)
     except Exception:
         log.exception("Handle conf command")
 
 def recv_can_handshake(msg):
     conf_sender.recv_can_handshake(msg)
 
+class Timer():
+    "A callback, due at a monotonic time. Same interface as asyncio.TimerHandle."
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+timers = []     # heap of (when, seq, Timer)
+timer_seq = itertools.count()
+
+def call_later(delay, callback):
+    "Schedule callback in the main loop"
+    t = Timer(time.monotonic() + delay, callback)
+    heapq.heappush(timers, (t.when, next(timer_seq), t))
+    return t
+
+def run_timers():
+    now = time.monotonic()
+    while timers and timers[0][0] <= now:
+        t = heapq.heappop(timers)[2]
+        if not t.cancelled:
+            t.callback()
+
+def timers_timeout():
+    "Seconds until the next timer is due, or None"
+    while timers and timers[0][2].cancelled:
+        heapq.heappop(timers)
+    if not timers:
+        return None
+    return max(0, timers[0][0] - time.monotonic())
+
+def loop_timeout(*timeouts):
+    timeouts = [t for t in timeouts if t is not None]
+    return min(timeouts) if timeouts else None
+
+# Seconds to wait for the handshake OPEN reply, doubled on each retry
+conf_open_timeout = float(os.getenv("CONF_OPEN_TIMEOUT", "2"))
+conf_open_retries = int(os.getenv("CONF_OPEN_RETRIES", "4"))
+# Seconds to collect config writes, before they are sent in one open cycle
+conf_write_window = float(os.getenv("CONF_WRITE_WINDOW", "0.2"))
+# Seconds to wait for the config frame, which confirms a write
+conf_verify_timeout = float(os.getenv("CONF_VERIFY_TIMEOUT", "30"))
+# Publish requested config values right away, marked as pending, and roll back failed writes
+conf_optimistic = os.getenv("CONF_OPTIMISTIC", "1") == "1"
+
+
+class PendingWrite:
+    "A sent config byte, waiting for its echo"
+    __slots__ = ("byte", "vname", "value", "sent", "echoed", "timer")
+
+    def __init__(self, byte, vname, value, sent):
+        self.byte = byte
+        self.vname = vname
+        self.value = value
+        self.sent = sent
+        # Last differing byte received for the position
+        self.echoed = None
+        self.timer = None
+
+
 class ConfSender():
+    """
+    Sends config writes through the handshake channel:
+    CLOSED -> (writes collected for conf_write_window) -> send OPEN request -> WAIT_OPEN
+    WAIT_OPEN -> OPEN reply -> OPEN, send all pending writes
+    WAIT_OPEN -> no reply within the open timeout -> retry with doubled timeout, drop the writes after the last
+    OPEN -> channel lifetime minus a margin passed, or CLOSE received -> CLOSED
+    The channel lifetime is learned from the observed CLOSE messages.
+    """
     CLOSED = 0
     OPEN = 1
     WAIT_OPEN = 2
 
     CAN_ID_SOURCE = 0x11
     CAN_ID_DEST = 1
-    def __init__(self):
+    # The "channel" closes after about 20 seconds, so reuse it, if in time
+    OPEN_REUSE = 15
+    # Stop reusing the channel this many seconds before it is expected to close
+    CLOSE_MARGIN = 3
+    # Accepted range of learned channel lifetimes
+    LIFETIME_MIN = 5
+    LIFETIME_MAX = 120
+    # The reuse time follows a low percentile of this many recent lifetimes, so single early closes are outvoted
+    LIFETIME_SAMPLES = 8
+
+    def __init__(self, call_later=call_later):
         self.state = self.CLOSED
-        self.queue_pending = queue.Queue()
+        # Write combining: (oid, block offset) -> {index in block: byte}, in order of the first write
+        self.pending = {}
+        # (oid, block offset) -> monotonic time of the first pending write
+        self.pending_since = {}
+        # (oid, block offset, index in block) -> PendingWrite, sent and waiting for the echo
+        self.verifying = {}
+        self.results = {"confirmed": 0, "failed": 0, "timeout": 0, "superseded": 0}
+        # (oid, value name) of optimistically published values, see ConfBase.publish_optimistic
+        self.optimistic = set()
+        self.call_later = call_later
+        self.expire_timer = None
+        self.open_timer = None
+        self.window_timer = None
+        self.open_attempts = 0
+        self.opened_at = None
+        self.open_reuse = self.OPEN_REUSE
+        self.lifetimes = deque(maxlen=self.LIFETIME_SAMPLES)
+        self.stats = {
+            "writes": 0,        # values to set
+            "superseded": 0,    # values replaced by a newer write before sending
+            "frames": 0,        # CAN frames sent
+            "opens": 0,         # OPEN requests sent, including retries
+            "open_timeouts": 0,
+            "dropped": 0,       # frames dropped after the last retry
+            "last_latency": None,   # seconds from set_cnf to CAN send of the last frame
+            "max_latency": 0.0,
+        }
 
     def recv_can_handshake(self, msg):
+        if len(msg.data) != 8:
+            return
         oid = msg.data[0]
         off = msg.data[1]
         if msg.pkid != enc_can_id(1, 1) or oid != 0xfb or off != 0x04:
@@ -715,53 +880,326 @@ class ConfSender():
         flag = msg.data[3]
         if flag == 0 and peer == self.CAN_ID_SOURCE:
             self.state = self.OPEN
-            self.OPEN_since = timestamp()
+            self.open_attempts = 0
+            self.opened_at = time.monotonic()
+            self.cancel_timers()
+            self.expire_timer = self.call_later(self.open_reuse, self.expire_open)
             log_send.info("Recv CAN handshake OPEN %x %x", peer, flag)
             self.send_pending()
 
         elif peer == 0xff and flag == 0:
-            self.state = self.CLOSED
             log_send.info("Recv CAN handshake CLOSED %x %x", peer, flag)
+            self.learn_lifetime()
+            if self.state == self.WAIT_OPEN:
+                # The close of a previous channel, our OPEN request is still pending
+                return
+            self.state = self.CLOSED
+            self.cancel_timers()
+            if self.pending:
+                self.schedule_open()
 
         else:
             log_send.debug("Recv CAN handshake _other_ %x %x", peer, flag)
 
-    def send_conf(self, oname, vname, value):
-        oid = conf_names[oname]
+    def learn_lifetime(self):
+        "Adjust the reuse time of the channel to the observed time from OPEN to CLOSE"
+        if self.opened_at is None:
+            return
+        lifetime = time.monotonic() - self.opened_at
+        self.opened_at = None
+        if not self.LIFETIME_MIN <= lifetime <= self.LIFETIME_MAX:
+            log_send.debug("Ignore channel lifetime %.1f s", lifetime)
+            return
+        self.lifetimes.append(lifetime)
+        # The minimum up to 3 samples, then the 25th percentile
+        reuse = sorted(self.lifetimes)[len(self.lifetimes) // 4] - self.CLOSE_MARGIN
+        if reuse != self.open_reuse:
+            log_send.info("Channel closed after %.1f s, reuse it for %.1f s", lifetime, reuse)
+            self.open_reuse = reuse
+
+    def queue_conf(self, oid, off, mi, b, received=None, vname=None, value=None):
+        "Merge the write into the pending frame of its block"
+        block = self.pending.setdefault((oid, off), {})
+        if mi in block:
+            self.stats["superseded"] += 1
+        block[mi] = (b, vname, value)
+        self.pending_since.setdefault((oid, off), received or time.monotonic())
+        self.stats["writes"] += 1
+
+    def send_conf(self, oname, vname, value, received=None):
+        self.send_conf_values(oname, {vname: value}, received)
+
+    def send_conf_values(self, oname, values, received=None):
+        self.send_conf_oid(conf_names[oname], values, received)
+
+    def send_conf_oid(self, oid, values, received=None):
+        """
+        Set several values of one object, values in the same block are sent in one frame.
+        Nothing is queued, if any value cannot be encoded or decoded back.
+        received: time.monotonic() of the command, for the latency statistics
+        """
         obj = get_data_object(oid, conf_types)
-        off, mem = obj.encode(vname, value)
-        log_send.debug("Set config for %x %s/%s to %s", oid, oname, vname, str(value))
-        self.queue_pending.put((oid, off, mem))
-
-        # The "channel" closes after about 20 seconds, so reuse it, if in time
-        if self.state == self.OPEN and timestamp() - self.OPEN_since < 15:
+        oname = obj.name
+        encoded = [obj.encode_byte(vname, value) for vname, value in values.items()]
+        decoded = [obj.decode_byte(vname, b) for vname, (off, mi, b) in zip(values, encoded)]
+        for (vname, value), (off, mi, b), v in zip(values.items(), encoded, decoded):
+            log_send.debug("Set config for %x %s/%s to %s", oid, oname, vname, str(value))
+            self.queue_conf(oid, off, mi, b, received, vname, value)
+            # Without a value read from the controller, a failed write couldn't be rolled back
+            if conf_optimistic and vname in obj.values:
+                self.optimistic.add((oid, vname))
+                obj.publish_optimistic(vname, v, value)
+        if self.state != self.WAIT_OPEN:
+            # Collect further writes, then send them in one go
+            self.schedule_open()
+
+    def schedule_open(self):
+        if not self.window_timer:
+            self.window_timer = self.call_later(conf_write_window, self.window_done)
+
+    def window_done(self):
+        self.window_timer = None
+        if self.state == self.OPEN:
             log_send.debug("Still OPEN, send now")
             self.send_pending()
-        else:
-            # wait for open and send
+        elif self.state == self.CLOSED and self.pending:
+            self.open_attempts = 0
             self.send_handshake_open()
 
+    def cancel_timers(self):
+        for name in ("expire_timer", "open_timer", "window_timer"):
+            t = getattr(self, name)
+            if t:
+                t.cancel()
+                setattr(self, name, None)
+
+    def expire_open(self):
+        "The channel is about to close, don't reuse it anymore"
+        log_send.debug("OPEN expired")
+        self.expire_timer = None
+        if self.state == self.OPEN:
+            self.state = self.CLOSED
+            if self.pending:
+                self.schedule_open()
+
     def send_handshake_open(self):
         log_send.debug("Send handshake OPEN")
+        self.state = self.WAIT_OPEN
+        self.stats["opens"] += 1
+        timeout = conf_open_timeout * 2 ** self.open_attempts
+        self.open_attempts += 1
+        self.open_timer = self.call_later(timeout, self.open_timeout)
         send_can_msg(self.CAN_ID_DEST, self.CAN_ID_SOURCE, 0xfb, 9, [self.CAN_ID_DEST, 1, 0, 0, 0, 0])
 
+    def open_timeout(self):
+        self.open_timer = None
+        if self.state != self.WAIT_OPEN:
+            return
+        self.stats["open_timeouts"] += 1
+        if self.open_attempts <= conf_open_retries:
+            log_send.warning("No handshake OPEN reply, retry %d", self.open_attempts)
+            self.send_handshake_open()
+            return
+        log_send.error("No handshake OPEN reply after %d attempts, drop %d config frames",
+                       self.open_attempts, len(self.pending))
+        self.stats["dropped"] += len(self.pending)
+        for (oid, off), block in self.pending.items():
+            for mi, (b, vname, value) in block.items():
+                self.write_result(oid, vname, value, "failed", reason="no handshake reply")
+        self.pending.clear()
+        self.pending_since.clear()
+        self.state = self.CLOSED
+        self.open_attempts = 0
+
     def send_pending(self):
-        while True:
+        while self.pending:
+            (oid, off), block = next(iter(self.pending.items()))
+            del self.pending[(oid, off)]
+            since = self.pending_since.pop((oid, off), None)
+            # 0x65 means "empty", which means, keep the current value.
+            mem = [0x65]*6
+            for mi, (b, vname, value) in block.items():
+                mem[mi] = b
             try:
-                oid, off, mem = self.queue_pending.get_nowait()
                 log_send.info("Sending config for 0x%x at 0x%x %s", oid, off, str(mem))
                 send_can_msg(self.CAN_ID_DEST, self.CAN_ID_SOURCE, oid, off, mem)
-                self.queue_pending.task_done()
-            except queue.Empty:
-                break
-            except Exception:
+                self.stats["frames"] += 1
+            except Exception as E:
                 log.exception("Error sending config updates")
+                for mi, (b, vname, value) in block.items():
+                    self.write_result(oid, vname, value, "failed", reason=str(E))
+                continue
+            for mi, (b, vname, value) in block.items():
+                self.expect_echo(oid, off, mi, b, vname, value)
+            if since is not None:
+                latency = time.monotonic() - since
+                self.stats["last_latency"] = latency
+                self.stats["max_latency"] = max(self.stats["max_latency"], latency)
+                if metrics.enabled:
+                    metric_conf_write_seconds.observe(latency)
+
+    def expect_echo(self, oid, off, mi, b, vname, value):
+        "Wait for the config frame of the block, which confirms the sent byte"
+        key = (oid, off, mi)
+        old = self.verifying.pop(key, None)
+        if old:
+            old.timer.cancel()
+            self.write_result(oid, old.vname, old.value, "superseded")
+        w = PendingWrite(b, vname, value, time.monotonic())
+        w.timer = self.call_later(conf_verify_timeout, lambda: self.verify_timeout(key))
+        self.verifying[key] = w
+
+    def check_echo(self, msg):
+        """
+        Compare a received config frame with the writes waiting for it.
+        Called before the change detection, which drops echoes of unchanged values.
+        Returns:
+            (oid, value name) of the confirmed writes, to settle after decoding the frame
+        """
+        data = msg.data
+        confirmed = []
+        if len(data) != 8 or msg.pkid & 0x1f == self.CAN_ID_SOURCE:
+            # Not a config frame or our own
+            return confirmed
+        oid, off = data[0], data[1]
+        for mi in range(6):
+            w = self.verifying.get((oid, off, mi))
+            if w is None:
+                continue
+            if data[2 + mi] == w.byte:
+                del self.verifying[(oid, off, mi)]
+                w.timer.cancel()
+                latency = time.monotonic() - w.sent
+                if metrics.enabled:
+                    metric_conf_confirm_seconds.observe(latency)
+                self.write_result(oid, w.vname, w.value, "confirmed", settle=False, latency=latency)
+                confirmed.append((oid, w.vname))
+            else:
+                # Possibly an older state, the controller may still apply the write
+                w.echoed = data[2 + mi]
+        return confirmed
+
+    def verify_timeout(self, key):
+        w = self.verifying.pop(key, None)
+        if not w:
+            return
+        if w.echoed is None:
+            self.write_result(key[0], w.vname, w.value, "timeout")
+        else:
+            self.write_result(key[0], w.vname, w.value, "failed", reason="echoed byte 0x{0:02x}".format(w.echoed))
+
+    def write_result(self, oid, vname, value, status, settle=True, **details):
+        """
+        Publish the outcome of a config write: confirmed, failed, timeout or superseded
+        settle: also replace an optimistically published value, see settle
+        """
+        self.results[status] += 1
+        oname = conf_types[oid].name
+        log_send.info("Config write %s/%s = %s: %s %s", oname, vname, value, status, details)
+        if vname is not None:
+            mqtt_logamatic.publish_write_result(oname, vname, dict(details, status=status, value=value))
+        if settle:
+            self.settle(oid, vname, status)
+
+    def settle(self, oid, vname, status):
+        "Replace the optimistically published value by the decoded one"
+        if status != "superseded" and (oid, vname) in self.optimistic:
+            self.optimistic.discard((oid, vname))
+            get_data_object(oid, conf_types).reconcile(vname, status)
 
     def request_settings(self):
         "This causes the receiver to dump its settings"
         log_send.info("Request all settings")
         send_can_msg(self.CAN_ID_DEST, self.CAN_ID_SOURCE, 0xfb, 1, [0]*6)
 
+metric_conf_write_seconds = metrics.histogram("logamatic_conf_write_seconds", "Time from set_cnf to the CAN send of the config frame")
+metric_conf_confirm_seconds = metrics.histogram("logamatic_conf_confirm_seconds",
+                                                "Time from the CAN send of a config write to its echo")
+metrics.gauge("logamatic_conf_pending", "Config frames waiting for the handshake", lambda: len(conf_sender.pending))
+metrics.gauge("logamatic_conf_dropped_total", "Config frames dropped without handshake reply",
+              lambda: conf_sender.stats["dropped"], "counter")
+
+snapshot_file = os.getenv("SNAPSHOT_FILE", "")
+snapshot_interval = float(os.getenv("SNAPSHOT_INTERVAL", "300"))
+# Skip the settings dump, if the restored snapshot is younger
+snapshot_max_age = float(os.getenv("SNAPSHOT_MAX_AGE", "3600"))
+SNAPSHOT_VERSION = 1
+
+def save_snapshot(fn):
+    """
+    Write the state of all data objects and the sent discovery messages.
+    Format: marshal of a dict, written atomically.
+    """
+    snap = {
+        "version": SNAPSHOT_VERSION,
+        "time": timestamp(),
+        "objects": {oid: o.get_state() for oid, o in data_objects.items()},
+        "discovery_sent": sorted(mqtt_logamatic.discovery_sent),
+    }
+    tmp = fn + ".tmp"
+    with open(tmp, "wb") as f:
+        marshal.dump(snap, f)
+    os.replace(tmp, fn)
+    log.debug("Saved snapshot of %d objects", len(data_objects))
+
+def load_snapshot(fn):
+    """
+    Restore the data objects from a snapshot and publish their values.
+    If the snapshot contains config and is younger than snapshot_max_age,
+    the settings are not requested again.
+    Returns:
+        True if a snapshot was restored
+    """
+    global conf_requested
+    try:
+        with open(fn, "rb") as f:
+            snap = marshal.load(f)
+        if snap.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("Snapshot version {}".format(snap.get("version")))
+    except FileNotFoundError:
+        return False
+    except (EOFError, ValueError, TypeError) as E:
+        log.warning("Ignore snapshot %s: %s", fn, E)
+        return False
+    # Only skip the settings dump, if all restored config objects received config blocks.
+    # Objects are also created by commands, before any config was received. The dump
+    # doesn't send all blocks of an object, so a complete memory can't be required.
+    has_conf = False
+    conf_complete = True
+    for oid, state in snap["objects"].items():
+        types = monitor_types if oid in monitor_types else conf_types
+        o = get_data_object(oid, types)
+        if not o:
+            continue
+        try:
+            o.set_state(state)
+        except ValueError as E:
+            log.warning("%s", E)
+            continue
+        for i in o.mem_received:
+            block_cache[(oid, i)] = bytes((oid, i)) + o.mem[i:i+Obase.blocklen]
+        if isinstance(o, ConfBase):
+            has_conf = True
+            conf_complete &= bool(o.mem_received)
+    mqtt_logamatic.discovery_sent.update(snap["discovery_sent"])
+    for o in data_objects.values():
+        o.publish_all()
+    age = timestamp() - snap["time"]
+    if has_conf and conf_complete and age < snapshot_max_age:
+        conf_requested = True
+    log.info("Restored snapshot of %d objects, %.0f s old", len(snap["objects"]), age)
+    return True
+
+def start_snapshots(fn, call_later=call_later):
+    "Save a snapshot every snapshot_interval seconds"
+    def save():
+        try:
+            save_snapshot(fn)
+        except OSError:
+            log.exception("Save snapshot")
+        call_later(snapshot_interval, save)
+    call_later(snapshot_interval, save)
+
 valuefile = None
 valuestr = ""
 
@@ -772,15 +1210,33 @@ if __name__ == "__main__":
     try:
         valuefile = sys.argv[1]
     except: pass
+    metrics.start()
     mqtt_can.start(can_recv_callback)
     mqtt_logamatic.start(mqtt_command_callback)
+    if snapshot_file:
+        load_snapshot(snapshot_file)
+        start_snapshots(snapshot_file)
     try:
         while True:
-            m = recv_queue.get()
-            m.handler(m.msg)
-            recv_queue.task_done()
+            try:
+                m = recv_queue.get(timeout=loop_timeout(mqtt_logamatic.flush_timeout(), timers_timeout()))
+                if metrics.enabled:
+                    t0 = time.perf_counter()
+                    m.handler(m.msg)
+                    metric_handler_seconds.observe(time.perf_counter() - t0, (m.handler.__name__,))
+                else:
+                    m.handler(m.msg)
+                recv_queue.task_done()
+            except queue.Empty:
+                pass
+            run_timers()
+            if mqtt_logamatic.flush_due(recv_queue.empty()):
+                mqtt_logamatic.flush()
     except KeyboardInterrupt:
         mqtt_can.stop()
         mqtt_logamatic.stop()
+        if snapshot_file:
+            save_snapshot(snapshot_file)
+        log.info("Frames %s", frame_stats())
         log.info("Exit")
         sys.exit(0)
@@ -0,0 +1,153 @@
+"""
+Optional asyncio runtime for logamatic4000.
+
+One event loop drives both MQTT clients through paho's socket callbacks,
+so there are no network threads and no receive queue. Incoming messages
+are decoded directly in the read callback, updates are flushed from the
+loop and the ConfSender timers are scheduled on the loop.
+
+Run with: python3 logamatic_async.py
+"""
+import asyncio
+import logging
+import time
+import paho.mqtt.client
+import metrics
+import mqtt_can
+import mqtt_logamatic
+import logamatic4000
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class AsyncMqtt:
+    "Drives a paho client from an asyncio event loop"
+    # Packets to read per readable event, so bursts are handled in one go
+    MAX_PACKETS = 100
+    RECONNECT_DELAY = 5
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        log.debug("Socket open")
+        self.loop.add_reader(sock, self.read)
+        if not self.misc:
+            self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        log.debug("Socket close")
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    def read(self):
+        self.client.loop_read(self.MAX_PACKETS)
+
+    async def misc_loop(self):
+        "Keepalive and reconnect"
+        while True:
+            if self.client.loop_misc() == paho.mqtt.client.MQTT_ERR_NO_CONN:
+                await asyncio.sleep(self.RECONNECT_DELAY)
+                try:
+                    log.info("Reconnect")
+                    self.client.reconnect()
+                except OSError as E:
+                    log.warning("Reconnect failed: %s", E)
+                continue
+            await asyncio.sleep(1)
+
+    def stop(self):
+        if self.misc:
+            self.misc.cancel()
+        self.client.disconnect()
+
+
+class Runtime:
+    def __init__(self, loop):
+        self.loop = loop
+        self.flush_handle = None
+
+    def can_recv(self, msgs):
+        self.handle(logamatic4000.handle_can_recv_batch, msgs)
+
+    def command(self, msg):
+        self.handle(logamatic4000.handle_cmd, msg)
+
+    def handle(self, handler, msg):
+        if metrics.enabled:
+            t0 = time.perf_counter()
+            handler(msg)
+            logamatic4000.metric_handler_seconds.observe(time.perf_counter() - t0, (handler.__name__,))
+        else:
+            handler(msg)
+        self.schedule_flush()
+
+    def call_later(self, delay, callback, *args):
+        "loop.call_later, which also flushes the updates published by callback"
+        def run():
+            try:
+                callback(*args)
+            finally:
+                self.schedule_flush()
+        return self.loop.call_later(delay, run)
+
+    def schedule_flush(self):
+        if self.flush_handle or not (mqtt_logamatic.pending_publish or mqtt_logamatic.rediscover_requested):
+            return
+        timeout = None if mqtt_logamatic.rediscover_requested else mqtt_logamatic.flush_timeout()
+        if timeout is None:
+            # Flush after the packets of the current read
+            self.flush_handle = self.loop.call_soon(self.flush)
+        else:
+            self.flush_handle = self.loop.call_later(timeout, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        mqtt_logamatic.flush()
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    runtime = Runtime(loop)
+    metrics.start()
+    logamatic4000.conf_sender.call_later = runtime.call_later
+    mqtt_logamatic.rediscover_callback = runtime.schedule_flush
+    mqtt_can.wait_published = False
+    can = AsyncMqtt(loop, mqtt_can.client)
+    logamatic = AsyncMqtt(loop, mqtt_logamatic.client)
+    mqtt_can.connect(runtime.can_recv)
+    mqtt_logamatic.connect(runtime.command)
+    if logamatic4000.snapshot_file:
+        logamatic4000.load_snapshot(logamatic4000.snapshot_file)
+        logamatic4000.start_snapshots(logamatic4000.snapshot_file, loop.call_later)
+        runtime.schedule_flush()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        mqtt_logamatic.flush()
+        if logamatic4000.snapshot_file:
+            logamatic4000.save_snapshot(logamatic4000.snapshot_file)
+        can.stop()
+        logamatic.stop()
+        log.info("Frames %s", logamatic4000.frame_stats())
+        log.info("Publish stats %s", mqtt_logamatic.publish_stats)
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        log.info("Exit")
@@ -0,0 +1,170 @@
+"""
+Optional metrics in the Prometheus text format.
+
+With METRICS_PORT set, the instrumented hot paths count and time their work
+and the metrics are served on http://METRICS_HOST:METRICS_PORT/metrics,
+by default on 127.0.0.1 only. Without, the instrumented code only checks
+metrics.enabled.
+
+Usage in a module:
+    decode_seconds = metrics.histogram("logamatic_decode_seconds", "Decode time of a block")
+    ...
+    if metrics.enabled:
+        decode_seconds.observe(time.perf_counter() - t0)
+"""
+import bisect
+import http.server
+import logging
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+port = int(os.getenv("METRICS_PORT", "0"))
+host = os.getenv("METRICS_HOST", "127.0.0.1")
+enabled = port > 0
+
+# Seconds, from 10 µs to 10 s
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(n, str(v).replace('"', '\\"')) for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        # label values tuple -> count
+        self.values = {}
+
+    def inc(self, labels=(), v=1):
+        self.values[labels] = self.values.get(labels, 0) + v
+
+    def render(self):
+        yield "# HELP {0} {1}\n# TYPE {0} counter\n".format(self.name, self.help)
+        for labels, v in list(self.values.items()):
+            yield "{0}{1} {2}\n".format(self.name, format_labels(self.labelnames, labels), v)
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # label values tuple -> [count per bucket (and +Inf), sum]
+        self.values = {}
+
+    def observe(self, v, labels=()):
+        h = self.values.get(labels)
+        if h is None:
+            h = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        h[0][bisect.bisect_left(self.buckets, v)] += 1
+        h[1] += v
+
+    def render(self):
+        yield "# HELP {0} {1}\n# TYPE {0} histogram\n".format(self.name, self.help)
+        for labels, (counts, total) in list(self.values.items()):
+            counts = list(counts)
+            cumulative = 0
+            for le, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                yield "{0}_bucket{1} {2}\n".format(
+                    self.name, format_labels(self.labelnames + ("le",), labels + (le,)), cumulative)
+            lbl = format_labels(self.labelnames, labels)
+            yield "{0}_sum{1} {2}\n{0}_count{1} {3}\n".format(self.name, lbl, total, cumulative)
+
+
+class Gauge:
+    """
+    Value read at scrape time from callback().
+    kind "counter" exposes an existing counter, e.g. of publish_stats, as Prometheus counter.
+    """
+    def __init__(self, name, help, callback, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.kind = kind
+
+    def render(self):
+        yield "# HELP {0} {1}\n# TYPE {0} {2}\n{0} {3}\n".format(self.name, self.help, self.kind, self.callback())
+
+
+registry = []
+
+
+def counter(name, help, labelnames=()):
+    m = Counter(name, help, labelnames)
+    registry.append(m)
+    return m
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    m = Histogram(name, help, labelnames, buckets)
+    registry.append(m)
+    return m
+
+
+def gauge(name, help, callback, kind="gauge"):
+    m = Gauge(name, help, callback, kind)
+    registry.append(m)
+    return m
+
+
+def render():
+    "All metrics in the Prometheus text format"
+    out = []
+    for m in registry:
+        try:
+            out.extend(m.render())
+        except Exception:
+            log.exception("Render metric %s", m.name)
+    return "".join(out)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+server = None
+
+
+def start():
+    "Serve the metrics from a daemon thread, if enabled"
+    global server
+    if not enabled or server:
+        return
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Metrics on http://%s:%d/metrics", host, port)
+
+
+def stop():
+    global server
+    if server:
+        server.shutdown()
+        server.server_close()
+        server = None
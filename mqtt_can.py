@@ -4,14 +4,38 @@ A CAN bus gateway over MQTT
 import paho.mqtt.client
 import logging
 from dotenv import load_dotenv
+import concurrent.futures
 import os
+import struct
+import threading
+import time
+import metrics
 
 load_dotenv()
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
+# "text": "rtr;id;data" hex strings, "binary": packed FRAME records, several per message
+can_format = os.getenv("CAN_FORMAT", "text")
+topic_recv = "/heizung/burner/can/raw/recv/"
+topic_send = "/heizung/burner/can/raw/send"
+topic_bin_recv = "/heizung/burner/can/bin/recv/"
+topic_bin_send = "/heizung/burner/can/bin/send"
+
+# flags (bit 0: rtr), 11 bit id, dlc, data padded to 8 bytes
+FRAME = struct.Struct("<BHB8s")
+FRAME_HEAD = struct.Struct("<BHB")
+FLAG_RTR = 0x01
+
 class CanMsg:
+    """
+    A received or sent CAN frame.
+    data is immutable (bytes or a memoryview of bytes) and may be referenced,
+    e.g. by the change detection in logamatic4000.
+    """
+    __slots__ = ("rtr", "pkid", "data")
+
     def __init__(self, pkid, data, rtr=0):
         self.rtr = rtr
         self.pkid = pkid
@@ -19,48 +43,188 @@ class CanMsg:
 
 def on_connect(client, userdata, flags, rc, properties=None):
     log.info("on_connect rc %d", rc);
-    client.subscribe("/heizung/burner/can/raw/recv/")
+    client.subscribe(topic_bin_recv if can_format == "binary" else topic_recv)
 
 def on_message(client, userdata, msg):
     try:
-        m = msg.payload.decode().split(";")
-        log.debug("on_message %s : %s", msg.topic, str(m))
-        canmsg = CanMsg(int(m[1], base=16), bytes.fromhex(m[2].strip("\x00")), int(m[0]))
-        callback(canmsg)
+        log.debug("on_message %s : %s", msg.topic, msg.payload)
+        callback(parse_text_frames(msg.payload))
     except Exception as E:
         log.exception("Exception on_message %s : %s", msg.topic, msg.payload)
 
+def parse_text_frames(payload):
+    "Parse one or more newline separated 'rtr;id;data' frames"
+    msgs = []
+    for l in payload.decode().splitlines():
+        if not l.strip():
+            continue
+        m = l.split(";")
+        if len(m) != 3:
+            raise ValueError("CAN frame {!r} has no 3 fields".format(l))
+        msgs.append(CanMsg(int(m[1], base=16), bytes.fromhex(m[2].strip("\x00")), int(m[0])))
+    return msgs
+
+def on_message_binary(client, userdata, msg):
+    try:
+        callback(unpack_frames(msg.payload))
+    except Exception as E:
+        log.exception("Exception on_message_binary %s : %s", msg.topic, msg.payload.hex())
+
+def unpack_frames(payload):
+    "Unpack concatenated binary FRAME records"
+    if len(payload) % FRAME.size:
+        raise ValueError("Binary CAN payload length {} is no multiple of {}".format(len(payload), FRAME.size))
+    msgs = []
+    for o in range(0, len(payload), FRAME.size):
+        flags, pkid, dlc = FRAME_HEAD.unpack_from(payload, o)
+        d = o + FRAME_HEAD.size
+        msgs.append(CanMsg(pkid & 0x7ff, payload[d:d+min(dlc, 8)], flags & FLAG_RTR))
+    return msgs
+
+def pack_frame(pkid, data, rtr=0):
+    return FRAME.pack(FLAG_RTR if rtr else 0, pkid & 0x7ff, len(data), bytes(data))
+
 def on_disconnect(client, userdata, rc):
     log.info("on_disconnect rc %d", rc);
 
-def send_can(pkid, data, rtr=0):
-    mqt = "/heizung/burner/can/raw/send"
-    dstr = " ".join(["{0:x}".format(d) for d in data])
-    mqm = "{rtr:x};{i:x};{d:s}".format(rtr=rtr, i=pkid, d=dstr)
-    return client.publish(mqt, mqm, 1).wait_for_publish()
+def send_can(pkid, data, rtr=0, callback=None):
+    """
+    Publish a frame with QoS 1 without waiting for the broker.
+    Returns:
+        concurrent.futures.Future, done with the seconds until the broker acknowledged the
+        frame, or failed if the client refused it. callback(future) is called when done,
+        from the network thread.
+    """
+    if can_format == "binary":
+        mqt = topic_bin_send
+        mqm = pack_frame(pkid, data, rtr)
+    else:
+        mqt = topic_send
+        dstr = " ".join(["{0:x}".format(d) for d in data])
+        mqm = "{rtr:x};{i:x};{d:s}".format(rtr=rtr, i=pkid, d=dstr)
+    f = concurrent.futures.Future()
+    if callback:
+        f.add_done_callback(callback)
+    t0 = time.monotonic()
+    info = client.publish(mqt, mqm, 1)
+    send_stats["sent"] += 1
+    if info.rc not in (paho.mqtt.client.MQTT_ERR_SUCCESS, paho.mqtt.client.MQTT_ERR_NO_CONN):
+        # NO_CONN frames are queued by the client and sent after the reconnect
+        send_stats["failed"] += 1
+        log.warning("CAN send of %x %s failed: %s", pkid, bytes(data).hex(" "), paho.mqtt.client.error_string(info.rc))
+        f.set_exception(IOError(paho.mqtt.client.error_string(info.rc)))
+        return f
+    with send_lock:
+        early = info.mid in acked_early
+        if early:
+            acked_early.discard(info.mid)
+        else:
+            in_flight[info.mid] = (f, t0, pkid, data)
+    if early:
+        send_done(f, t0, pkid, data)
+    check_in_flight()
+    if wait_published:
+        f.result()
+    return f
+
+def on_publish(client, userdata, mid, *args):
+    with send_lock:
+        sent = in_flight.pop(mid, None)
+        if sent is None:
+            # Acknowledged before send_can registered it
+            acked_early.add(mid)
+            return
+    send_done(*sent)
+
+def send_done(f, t0, pkid, data):
+    latency = time.monotonic() - t0
+    send_stats["acked"] += 1
+    send_stats["max_latency"] = max(send_stats["max_latency"], latency)
+    if latency > slow_send:
+        send_stats["slow"] += 1
+        log.warning("Slow CAN send of %x %s: %.3f s", pkid, bytes(data).hex(" "), latency)
+    if metrics.enabled:
+        metric_send_latency.observe(latency)
+    f.set_result(latency)
+
+def check_in_flight():
+    "Log frames, which are waiting for the broker longer than slow_send, once"
+    global in_flight_warned
+    with send_lock:
+        if not in_flight:
+            return
+        oldest = min(in_flight.items(), key=lambda i: i[1][1])
+    mid, (f, t0, pkid, data) = oldest
+    age = time.monotonic() - t0
+    if age > slow_send and mid != in_flight_warned:
+        in_flight_warned = mid
+        log.warning("CAN send of %x %s waits for the broker since %.1f s, %d frames in flight",
+                    pkid, bytes(data).hex(" "), age, len(in_flight))
+
+def oldest_in_flight():
+    "Seconds the oldest unacknowledged frame waits, 0 if none"
+    with send_lock:
+        if not in_flight:
+            return 0
+        return time.monotonic() - min(t0 for f, t0, pkid, data in in_flight.values())
+
+# Seconds after which an unacknowledged send is reported
+slow_send = float(os.getenv("CAN_SEND_SLOW", "1.0"))
+send_lock = threading.Lock()
+# mid -> (future, publish time, pkid, data)
+in_flight = {}
+acked_early = set()
+in_flight_warned = None
+send_stats = {
+    "sent": 0,
+    "acked": 0,
+    "failed": 0,
+    "slow": 0,
+    "max_latency": 0.0,
+}
+
+metric_send_latency = metrics.histogram("logamatic_can_send_seconds", "Time until the broker acknowledged a CAN send")
+metrics.gauge("logamatic_can_send_in_flight", "CAN sends waiting for the broker", lambda: len(in_flight))
+metrics.gauge("logamatic_can_send_oldest_seconds", "Age of the oldest CAN send waiting for the broker", oldest_in_flight)
+metrics.gauge("logamatic_can_send_slow_total", "CAN sends acknowledged after CAN_SEND_SLOW",
+              lambda: send_stats["slow"], "counter")
 
 callback = None
+# Block in send_can until the broker has the message, e.g. for scripts.
+# Must be False, if the client is driven by the caller's event loop.
+wait_published = False
 
 client = paho.mqtt.client.Client(client_id="logamatic_mqtt_can_interface")
 client.on_connect = on_connect
 client.on_message = on_message
 client.on_disconnect = on_disconnect
+client.on_publish = on_publish
+client.message_callback_add(topic_bin_recv, on_message_binary)
 
-def start(deliver_callback):
-    log.info("Start MQTT CAN receiver")
+def connect(deliver_callback):
+    """
+    Connect without starting the network thread.
+    deliver_callback gets a list of CanMsg for each MQTT message.
+    """
     global callback
     callback = deliver_callback
     rc = client.connect(os.getenv('MQTT_READ_HOST', 'localhost'))
     log.info("client.connect %d", rc)
+
+def start(deliver_callback):
+    log.info("Start MQTT CAN receiver")
+    connect(deliver_callback)
     client.loop_start()
 
 def stop():
     log.info("Stop MQTT CAN receiver")
     client.loop_stop()
+    log.info("CAN send %s, %d in flight", send_stats, len(in_flight))
 
-def test_callback(msg):
+def test_callback(msgs):
     log.info("test_callback")
-    log.info("id %d data %s", msg.pkid, msg.data.hex())
+    for msg in msgs:
+        log.info("id %d data %s", msg.pkid, msg.data.hex())
 
 if __name__ == "__main__":
     logging.basicConfig()
@@ -4,6 +4,8 @@ from dotenv import load_dotenv
 import os
 import json
 import hashlib
+import time
+import metrics
 
 load_dotenv()
 
@@ -12,11 +14,16 @@ log.setLevel(logging.INFO)
 
 topic_prefix = os.getenv("TOPIC_PREFIX", "/heizung/logamatic/")
 discovery_prefix = os.getenv("DISCOVERY_PREFIX", "homeassistant/")
+# Updates are collected and flushed after each batch of received CAN messages,
+# or, if > 0, at most every PUBLISH_WINDOW seconds.
+publish_window = float(os.getenv("PUBLISH_WINDOW", "0"))
+publish_queue_max = int(os.getenv("PUBLISH_QUEUE_MAX", "1000"))
 
 
 def on_connect(client, userdata, flags, rc, properties=None):
     log.info("on_connect rc %d", rc)
     client.subscribe(topic_prefix + "set_cnf/#")
+    client.subscribe(ha_status_topic)
 
 
 def on_message(client, userdata, msg):
@@ -27,6 +34,16 @@ def on_message(client, userdata, msg):
         log.exception("Exception on_message %s : %s", msg.topic, msg.payload)
 
 
+def on_ha_status(client, userdata, msg):
+    "Home Assistant announces a restart. Announce discovery again from the main loop."
+    global rediscover_requested
+    log.info("Home Assistant status %s", msg.payload)
+    if msg.payload == b"online":
+        rediscover_requested = True
+        if rediscover_callback:
+            rediscover_callback()
+
+
 def on_disconnect(client, userdata, rc):
     log.info("on_disconnect rc %d", rc)
 
@@ -43,52 +60,218 @@ def get_set_cnf_topic(prefix, key):
     return t
 
 
+def get_result_topic(oname, key):
+    "Topic of the outcome of config writes, see ConfSender.write_result"
+    t = "/".join([topic_prefix, "cnf_result", oname, key])
+    t = t.replace("//", "/")
+    return t
+
+
+def publish_write_result(oname, key, result):
+    "result: dict with status, value and details, published as JSON"
+    queue_publish(get_result_topic(oname, key), json.dumps(result))
+
+
+class TopicEntry:
+    "Precomputed topics and discovery message of one value"
+    __slots__ = ("state_topic", "command_topic", "attributes_topic", "unique_id", "discovery_topic", "discovery_payload")
+
+    def __init__(self, prefix, key):
+        self.state_topic = get_state_topic(prefix, key)
+        self.command_topic = get_set_cnf_topic(prefix, key) if prefix[0] == "cnf" else None
+        # Pending state of config writes, see publish_attributes
+        self.attributes_topic = self.state_topic + "/attributes" if self.command_topic else None
+        self.unique_id = hashlib.sha1(self.state_topic.encode()).hexdigest()[:8]
+        self.discovery_topic = None
+        self.discovery_payload = None
+
+    def set_discovery(self, prefix, meta, value_fullname):
+        c = dict(meta)
+        c["name"] = "/".join(prefix + [value_fullname])
+        c["unique_id"] = self.unique_id
+        c["state_topic"] = self.state_topic
+        c["device"] = discovery_device
+        if "platform" not in c:
+            c["platform"] = "sensor"
+        if self.command_topic:
+            c["command_topic"] = self.command_topic
+            c["json_attributes_topic"] = self.attributes_topic
+        t = f"{discovery_prefix}/{c['platform']}/{self.unique_id}/config"
+        self.discovery_topic = t.replace("//", "/")
+        self.discovery_payload = json.dumps(c, indent=2)
+
+
+# (*prefix, key) -> TopicEntry
+topic_cache = {}
+
+
+def get_topic_entry(prefix, key, meta=None, value_fullname=None):
+    e = topic_cache.get((*prefix, key))
+    if e is None:
+        e = topic_cache[(*prefix, key)] = TopicEntry(prefix, key)
+    if meta and e.discovery_payload is None:
+        e.set_discovery(prefix, meta, value_fullname)
+    return e
+
+
 def publish_update(prefix, key, value, meta, monid, object_name, value_fullname):
-    if meta:
-        publish_discovery(prefix, key, meta, monid, object_name, value_fullname)
-    publish_value(prefix, key, value)
+    e = topic_cache.get((*prefix, key))
+    if e is None or (meta and e.discovery_payload is None):
+        e = get_topic_entry(prefix, key, meta, value_fullname)
+    if e.discovery_topic and e.discovery_topic not in discovery_sent:
+        send_discovery(e)
+    queue_publish(e.state_topic, value)
+
+
+def publish_attributes(prefix, key, attributes):
+    "Publish the JSON attributes of a config value, e.g. {'pending': True}"
+    e = get_topic_entry(prefix, key)
+    if e.attributes_topic:
+        queue_publish(e.attributes_topic, json.dumps(attributes))
 
 
 def publish_value(prefix, key, value):
-    t = get_state_topic(prefix, key)
+    t = get_topic_entry(prefix, key).state_topic
     log.debug("Send value %s", t)
-    client.publish(t, value, retain=True)
-
+    queue_publish(t, value)
+
+
+# topic -> payload, in order of the first update
+pending_publish = {}
+pending_since = 0
+publish_stats = {
+    "updates": 0,       # calls to queue_publish
+    "coalesced": 0,     # updates, which replaced a pending update of the same topic
+    "published": 0,     # messages handed to the client
+    "flushes": 0,
+    "full_flushes": 0,  # flushes forced by a full queue
+    "max_pending": 0,
+}
+
+
+def queue_publish(topic, payload):
+    "Queue a retained message. Pending updates of the same topic are replaced."
+    global pending_since
+    publish_stats["updates"] += 1
+    if topic in pending_publish:
+        publish_stats["coalesced"] += 1
+    else:
+        if len(pending_publish) >= publish_queue_max:
+            log.debug("Publish queue full")
+            publish_stats["full_flushes"] += 1
+            flush()
+        if not pending_publish:
+            pending_since = time.monotonic()
+    pending_publish[topic] = payload
+    if len(pending_publish) > publish_stats["max_pending"]:
+        publish_stats["max_pending"] = len(pending_publish)
+
+
+def flush_due(batch_done=True):
+    """
+    Args:
+        batch_done: True if the current batch of incoming messages has been handled
+    Returns:
+        True, if pending updates should be flushed now
+    """
+    if rediscover_requested:
+        return True
+    if not pending_publish:
+        return False
+    if publish_window > 0:
+        return time.monotonic() - pending_since >= publish_window
+    return batch_done
+
+
+def flush_timeout():
+    "Seconds until the pending updates are due, or None if there are none"
+    if not pending_publish or publish_window <= 0:
+        return None
+    return max(0, pending_since + publish_window - time.monotonic())
+
+
+def flush():
+    "Publish all pending updates"
+    if rediscover_requested:
+        invalidate_discovery()
+    if not pending_publish:
+        return
+    msgs = list(pending_publish.items())
+    pending_publish.clear()
+    log.debug("Flush %d updates", len(msgs))
+    if metrics.enabled:
+        t0 = time.monotonic()
+        metric_publish_delay.observe(t0 - pending_since)
+    for t, m in msgs:
+        client.publish(t, m, retain=True)
+    publish_stats["published"] += len(msgs)
+    publish_stats["flushes"] += 1
+    if metrics.enabled:
+        metric_flush_seconds.observe(time.monotonic() - t0)
+
+
+metric_publish_delay = metrics.histogram("logamatic_publish_delay_seconds",
+                                         "Time from the first pending update to its flush")
+metric_flush_seconds = metrics.histogram("logamatic_publish_flush_seconds",
+                                         "Time to hand all pending updates to the MQTT client")
+metrics.gauge("logamatic_published_total", "Messages handed to the MQTT client", lambda: publish_stats["published"], "counter")
+metrics.gauge("logamatic_publish_coalesced_total", "Updates replaced by a newer update of the same topic",
+              lambda: publish_stats["coalesced"], "counter")
+metrics.gauge("logamatic_publish_pending", "Pending updates", lambda: len(pending_publish))
+
+discovery_device = {"identifiers": ["logamatic"], "name": "Logamatic"}
 discovery_sent = set()
+rediscover_requested = False
+ha_status_topic = (discovery_prefix + "/status").replace("//", "/")
+
+
 def publish_discovery(prefix, key, meta, monid, object_name, value_fullname):
-    discovery_device = {"identifiers": ["logamatic"], "name": "Logamatic"}
-    state_topic = get_state_topic(prefix, key)
-    c = dict(meta)
-    c["name"] = "/".join(prefix + [value_fullname])
-    c["unique_id"] = hashlib.sha1(state_topic.encode()).hexdigest()[:8]
-    c["state_topic"] = state_topic
-    c["device"] = discovery_device
-    if "platform" not in c:
-        c["platform"] = "sensor"
-
-    if prefix[0] == "cnf":
-        c["command_topic"] = get_set_cnf_topic(prefix, key)
-
-    t = f"{discovery_prefix}/{c['platform']}/{c['unique_id']}/config"
-    t = t.replace("//", "/")
-    if t in discovery_sent:
-        return
-    m = json.dumps(c, indent=2)
-    log.debug("Send discovery %s", t)
-    client.publish(t, m, retain=True)
-    discovery_sent.add(t)
+    e = get_topic_entry(prefix, key, meta, value_fullname)
+    if e.discovery_topic not in discovery_sent:
+        send_discovery(e)
+
+
+def send_discovery(e):
+    log.debug("Send discovery %s", e.discovery_topic)
+    queue_publish(e.discovery_topic, e.discovery_payload)
+    discovery_sent.add(e.discovery_topic)
+
+
+def invalidate_discovery(republish=True):
+    """
+    Forget which discovery messages have been sent, e.g. after a Home Assistant restart.
+    Args:
+        republish: queue all known discovery messages again now,
+            otherwise they are sent with the next update of each value
+    """
+    global rediscover_requested
+    rediscover_requested = False
+    discovery_sent.clear()
+    if republish:
+        for e in topic_cache.values():
+            if e.discovery_topic:
+                send_discovery(e)
 
 
 callback = None
+# Called on a rediscovery request, for runtimes, which don't poll flush_due
+rediscover_callback = None
 
 client = paho.mqtt.client.Client(client_id="logamatic_mqtt_monitor_and_control")
 client.on_connect = on_connect
 client.on_message = on_message
 client.on_disconnect = on_disconnect
+client.message_callback_add(ha_status_topic, on_ha_status)
 
 
 def start(deliver_callback):
     log.info("Start")
+    connect(deliver_callback)
+    client.loop_start()
+
+
+def connect(deliver_callback):
+    "Connect without starting the network thread"
     global callback
     callback = deliver_callback
 
@@ -100,11 +283,12 @@ def start(deliver_callback):
     rc = client.connect(os.getenv("MQTT_WRITE_HOST", "localhost"))
 
     log.info("client.connect %d", rc)
-    client.loop_start()
 
 
 def stop():
     log.info("Stop")
+    flush()
+    log.info("Publish stats %s", publish_stats)
     client.loop_stop()
 
 
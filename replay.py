@@ -0,0 +1,124 @@
+"""
+Replay a recorded CAN dump through the full decoder, without broker and boiler.
+
+The dump has one frame per line, as written by
+mosquitto_sub -v -t /heizung/burner/can/raw/recv/
+optionally prefixed with a unix timestamp (mosquitto_sub -F "%U %t %p"):
+    1700000000.123 /heizung/burner/can/raw/recv/ 0;421;88 00 0c 19 05 13 00 00
+
+MQTT publishing and CAN sending are replaced by counters.
+
+Run with: python3 replay.py [--speed N] dumpfile
+"""
+import argparse
+import logging
+import time
+import logamatic4000
+import mqtt_can
+import mqtt_logamatic
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+stats = {
+    "frames": 0,
+    "values": 0,        # decoded value updates
+    "published": 0,     # MQTT messages, including discovery
+    "can_sent": 0,
+    "errors": 0,
+}
+
+
+def parse_line(l):
+    """
+    Returns:
+        timestamp or None, list of CanMsg
+    """
+    parts = l.split(None, 1)
+    ts = None
+    if parts and not parts[0].startswith("/") and ";" not in parts[0]:
+        ts = float(parts[0])
+        parts = parts[1].split(None, 1) if len(parts) > 1 else []
+    if parts and parts[0].startswith("/"):
+        parts = parts[1:]
+    if not parts:
+        raise ValueError("Line without payload")
+    return ts, mqtt_can.parse_text_frames(" ".join(parts).encode())
+
+
+def read_log(fn):
+    "Yields (timestamp, [CanMsg]) for each frame line of a dump"
+    with open(fn) as f:
+        for l in f:
+            if not l.strip():
+                continue
+            try:
+                yield parse_line(l)
+            except ValueError:
+                stats["errors"] += 1
+                log.debug("Skip line %s", l.strip())
+
+
+def stub_outputs():
+    "Count instead of publishing on MQTT and sending on CAN"
+    publish_update = mqtt_logamatic.publish_update
+
+    def count_update(*args):
+        stats["values"] += 1
+        publish_update(*args)
+
+    def count_publish(topic, payload=None, qos=0, retain=False):
+        stats["published"] += 1
+
+    def count_send(pkid, data, rtr=0):
+        stats["can_sent"] += 1
+
+    mqtt_logamatic.publish_update = count_update
+    mqtt_logamatic.client.publish = count_publish
+    mqtt_can.send_can = count_send
+
+
+def replay(frames, speed=0):
+    """
+    Args:
+        frames: iterable of (timestamp, [CanMsg])
+        speed: 1 for wall clock speed, N for N times faster, 0 for as fast as possible
+    Returns:
+        seconds elapsed
+    """
+    start = time.monotonic()
+    first_ts = None
+    for ts, msgs in frames:
+        if speed and ts is not None:
+            if first_ts is None:
+                first_ts = ts
+            delay = (ts - first_ts) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        logamatic4000.handle_can_recv_batch(msgs)
+        stats["frames"] += len(msgs)
+        if mqtt_logamatic.flush_due():
+            mqtt_logamatic.flush()
+        logamatic4000.run_timers()
+    mqtt_logamatic.flush()
+    return time.monotonic() - start
+
+
+def report(elapsed):
+    e = max(elapsed, 1e-9)
+    print("{0:d} frames in {1:.3f} s: {2:.0f} frames/s, {3:d} values ({4:.0f}/s), "
+          "{5:d} published, {6:d} CAN sent, {7:d} unparsable lines".format(
+              stats["frames"], elapsed, stats["frames"] / e, stats["values"], stats["values"] / e,
+              stats["published"], stats["can_sent"], stats["errors"]))
+    print("Change detection", logamatic4000.frame_stats())
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(description="Replay a recorded CAN dump through the decoder")
+    parser.add_argument("dumpfile")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="1: wall clock, N: N times faster, 0: as fast as possible (default)")
+    args = parser.parse_args()
+    stub_outputs()
+    report(replay(read_log(args.dumpfile), args.speed))